@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the query path. Each subcommand compares the
+previous implementation of a step against the current one:
+
+    python benchmark.py <benchmark> [options]
+"""
+import sys
+import argparse
+import datetime
+import gc
+import glob
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+sys.path.append("..")
+from ConsultaSunat import fake_sunat
+from ConsultaSunat.sunat import Sunat
+from ConsultaSunat.utils import (
+    CIIU,
+    Contribuyente,
+    ContribuyenteBatch,
+    DeudaCoactiva,
+    JSONEnabled,
+    dumps,
+    write_jsonl,
+    orjson
+)
+
+
+logger = logging.getLogger('sunat')
+# Anonymised result pages, generated with fake_sunat.result_page
+FIXTURE_PAGES = sorted(glob.glob(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures', 'resultado-*.html')
+))
+
+
+def report(name, seconds, number):
+    print("{name:<30} {per_call:10.3f} ms per call ({number} calls)".format(
+        name=name,
+        per_call=seconds / number * 1000,
+        number=number
+    ))
+
+
+def bench_captcha_capture(args):
+    """
+    Captcha capture from a full page screenshot: written to a temporary
+    file and read back vs. kept in memory
+    """
+    from PIL import Image, ImageDraw
+
+    page = Image.new('RGB', (args.width, args.height), 'white')
+    draw = ImageDraw.Draw(page)
+    for y in range(0, args.height, 20):
+        draw.text((10, y), "Consulta RUC " * 10, fill='black')
+    output = io.BytesIO()
+    page.save(output, 'PNG')
+    png = output.getvalue()
+
+    sunat = Sunat(None, logger)
+    loc = {'x': 300, 'y': 200}
+    size = {'width': 100, 'height': 40}
+
+    def tempfile_capture():
+        img_file = tempfile.NamedTemporaryFile()
+        img_file.write(png)
+        img_file.flush()
+        sunat.get_subimage(img_file.name, loc, size)
+        img_file.close()
+
+    def memory_capture():
+        sunat.get_subimage(io.BytesIO(png), loc, size)
+
+    report('tempfile screenshot', timeit.timeit(tempfile_capture, number=args.number), args.number)
+    report('in-memory screenshot', timeit.timeit(memory_capture, number=args.number), args.number)
+
+
+def legacy_find_fields(soup):
+    """
+    Previous field extraction, one full scan per field
+    """
+    patterns = [
+        'n[ú|u]mero\\s+de\\s+ruc:\\s+',
+        'nombre\\s+comercial:\\s*',
+        'estado\\s+del?\\s+contribuyente:\\s*',
+        'condici[ó|o]n\\s+del\\s+contribuyente:\\s*',
+    ]
+    return [
+        soup.find('td', {'class': 'bgn'}, text=re.compile(pattern, re.IGNORECASE))
+        .find_next('td').get_text().strip()
+        for pattern in patterns
+    ]
+
+
+def bench_parse(args):
+    """
+    Result page parsing over saved pages: per-field scans vs. label index,
+    and full parse with bs4 and lxml. Uses the pages in fixtures/ if none
+    are given
+    """
+    import bs4
+    import lxml.html
+
+    pages = []
+    for path in args.pages or FIXTURE_PAGES:
+        with open(path, encoding=args.encoding) as f:
+            pages.append(f.read())
+    soups = [bs4.BeautifulSoup(page, 'lxml') for page in pages]
+    trees = [lxml.html.fromstring(page) for page in pages]
+
+    sunat = Sunat(None, logger)
+    lxml_sunat = Sunat(None, logger, parser='lxml')
+    number = args.number * len(pages)
+
+    def legacy_fields():
+        for soup in soups:
+            legacy_find_fields(soup)
+
+    def indexed_fields_bs4():
+        for soup in soups:
+            sunat.get_indexed_fields(sunat.get_label_index_bs4(soup))
+
+    def indexed_fields_lxml():
+        for tree in trees:
+            sunat.get_indexed_fields(sunat.get_label_index_lxml(tree))
+
+    def parse_bs4():
+        for page in pages:
+            sunat.parse_results(page)
+
+    def parse_lxml():
+        for page in pages:
+            lxml_sunat.parse_results(page)
+
+    report('fields, per-field scans', timeit.timeit(legacy_fields, number=args.number), number)
+    report('fields, label index (bs4)', timeit.timeit(indexed_fields_bs4, number=args.number), number)
+    report('fields, label index (lxml)', timeit.timeit(indexed_fields_lxml, number=args.number), number)
+    report('full parse (bs4)', timeit.timeit(parse_bs4, number=args.number), number)
+    report('full parse (lxml)', timeit.timeit(parse_lxml, number=args.number), number)
+
+
+def bench_validate(args):
+    """
+    RUC validation: Sunat.validate_ruc per item vs. vectorized validate_rucs
+    """
+    import numpy
+    from ConsultaSunat.validation import validate_rucs
+
+    random = numpy.random.RandomState(0)
+    prefixes = random.choice([10, 15, 17, 20], args.size).astype(numpy.int64)
+    rucs = prefixes * 10 ** 9 + random.randint(0, 10 ** 9, args.size).astype(numpy.int64)
+    ruc_list = rucs.tolist()
+
+    expected = [Sunat.validate_ruc(ruc) for ruc in ruc_list]
+    if validate_rucs(rucs).tolist() != expected:
+        raise AssertionError("validate_rucs doesn't match Sunat.validate_ruc")
+
+    def per_item():
+        for ruc in ruc_list:
+            Sunat.validate_ruc(ruc)
+
+    def vectorized():
+        validate_rucs(rucs)
+
+    number = args.number * args.size
+    report('Sunat.validate_ruc', timeit.timeit(per_item, number=args.number), number)
+    report('validate_rucs', timeit.timeit(vectorized, number=args.number), number)
+
+
+def sample_record(index):
+    return {
+        'ruc': 20000000000 + index,
+        'nombre': 'EMPRESA DE PRUEBA {} S.A.C.'.format(index),
+        'nombre_comercial': '-',
+        'estado': 'ACTIVO' if index % 10 else 'BAJA DE OFICIO',
+        'condicion': 'HABIDO' if index % 7 else 'NO HABIDO',
+        'ciiu': [CIIU(51906, 'OTROS TIPOS DE VENTA AL POR MAYOR.')],
+        'deuda_coactiva': [],
+        'omision_tributaria': [],
+    }
+
+
+def measure_memory(build):
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+
+def bench_records(args):
+    """
+    Memory per taxpayer: dicts vs. slotted Contribuyente vs. ContribuyenteBatch
+    """
+    # The strings of the records are shared by every container, so the
+    # measurement only counts the containers themselves
+    records = [sample_record(index) for index in range(args.size)]
+
+    builders = [
+        ('dict', lambda: [dict(record) for record in records]),
+        ('Contribuyente', lambda: [Contribuyente.from_dict(record) for record in records]),
+        ('ContribuyenteBatch', lambda: ContribuyenteBatch(records)),
+    ]
+    for name, build in builders:
+        result, size = measure_memory(build)
+        print("{name:<30} {per_record:10.1f} bytes per record".format(
+            name=name,
+            per_record=size / args.size
+        ))
+        del result
+
+
+class LegacyDateJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if not isinstance(obj, datetime.date):
+            return json.dumps(obj, indent=2, ensure_ascii=False)
+        return {"year": obj.year, "month": obj.month}
+
+
+class LegacyJSONEncoder(json.JSONEncoder):
+    """
+    Previous encoder: a new date encoder per nested object and a
+    json.dumps fallback for everything else
+    """
+    def default(self, obj):
+        if isinstance(obj, DeudaCoactiva):
+            encoder = LegacyDateJSONEncoder()
+            return {
+                "monto": obj.monto,
+                "periodo_tributario": encoder.default(obj.periodo_tributario),
+                "fecha_inicio": encoder.default(obj.fecha_inicio),
+                "entidad_asociada": obj.entidad_asociada
+            }
+        if isinstance(obj, JSONEnabled):
+            return obj._json()
+        return json.dumps(obj, indent=2, ensure_ascii=False)
+
+
+def bench_serialize(args):
+    """
+    JSON output of the results: previous encoder vs. dumps/write_jsonl
+    """
+    records = [sample_record(index) for index in range(args.size)]
+    for record in records[::5]:
+        record['deuda_coactiva'] = [
+            DeudaCoactiva(1520.5, '2015-01', '10/03/2016', 'LIMA')
+        ]
+
+    candidates = [
+        ('legacy encoder, indented', lambda: json.dump(
+            records, io.StringIO(), ensure_ascii=False, indent=2, cls=LegacyJSONEncoder)),
+        ('dumps json, indented', lambda: dumps(records, indent=2, backend='json')),
+        ('dumps json, compact', lambda: dumps(records, backend='json')),
+        ('write_jsonl json', lambda: write_jsonl(records, io.StringIO(), backend='json')),
+    ]
+    if orjson is not None:
+        candidates += [
+            ('dumps orjson, indented', lambda: dumps(records, indent=2, backend='orjson')),
+            ('dumps orjson, compact', lambda: dumps(records, backend='orjson')),
+            ('write_jsonl orjson', lambda: write_jsonl(records, io.StringIO(), backend='orjson')),
+        ]
+
+    number = args.number * args.size
+    for name, serialize in candidates:
+        report(name, timeit.timeit(serialize, number=args.number), number)
+
+
+def bench_ocr(args):
+    """
+    Captcha reading from several worker threads: in the threads vs. OCR worker processes
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from ConsultaSunat.captcha import CaptchaSolver, load_samples
+
+    images = [image for image, text in load_samples(args.samples)]
+    number = args.number * len(images)
+    for name, processes in [('in worker threads', 0), ('OCR processes', args.processes)]:
+        solver = CaptchaSolver(logger, processes=processes)
+        # Starts the worker processes before measuring
+        solver.solve(images[0])
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            seconds = timeit.timeit(
+                lambda: list(executor.map(solver.solve, images)),
+                number=args.number
+            )
+        report(name, seconds, number)
+        print(solver.summary())
+        solver.close()
+
+
+def valid_rucs(number, start=2010000000):
+    """
+    The first number valid RUCs from the 10 digit prefix start
+    """
+    rucs = []
+    prefix = start
+    while len(rucs) < number:
+        for digit in range(10):
+            if Sunat.validate_ruc(prefix * 10 + digit):
+                rucs.append(prefix * 10 + digit)
+                break
+        prefix += 1
+    return rucs
+
+
+def bench_e2e(args):
+    """
+    Full consulta.py run against fake_sunat.py: RUCs per second, p95 query
+    latency and retries per success
+    """
+    from ConsultaSunat import consulta
+
+    fake = fake_sunat.create_fake(args)
+    server = fake_sunat.start_server(fake, args.host, args.port)
+    base_url = 'http://{}:{}'.format(*server.server_address)
+    rucs = valid_rucs(args.rucs)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outfile = os.path.join(tmpdir, 'results.jsonl')
+        metrics_file = os.path.join(tmpdir, 'metrics.json')
+        # The options of the harness come last so they take precedence
+        argv = [option for option in args.options if option != '--'] + [
+            '--ruc', *map(str, rucs),
+            '--base-url', base_url,
+            '--engine', args.engine,
+            '--workers', str(args.workers),
+            '--format', 'jsonl',
+            '-o', outfile,
+            '--metrics-file', metrics_file,
+        ]
+        start = time.perf_counter()
+        consulta.main(argv)
+        elapsed = time.perf_counter() - start
+
+        with open(outfile) as f:
+            successes = sum(1 for line in f if line.strip())
+        with open(metrics_file) as f:
+            stages = json.load(f)
+    server.shutdown()
+    server.server_close()
+
+    queries = stages.get('query', {}).get('count', 0)
+    print("{} of {} RUCs in {:.1f} s: {:.2f} RUCs/s".format(
+        successes, len(rucs), elapsed, successes / elapsed))
+    print("Query latency: p50 {:.3f} s, p95 {:.3f} s".format(
+        stages.get('query', {}).get('p50', 0), stages.get('query', {}).get('p95', 0)))
+    print("Retries per success: {:.2f}".format(
+        (queries - successes) / successes if successes else float('nan')))
+    print("Server: {}".format(fake.stats()))
+
+
+def write_padron(path, rows):
+    """
+    Synthetic padrón reducido with rows taxpayers
+    """
+    estados = ['ACTIVO', 'ACTIVO', 'ACTIVO', 'BAJA DE OFICIO', 'BAJA DEFINITIVA']
+    condiciones = ['HABIDO', 'HABIDO', 'NO HABIDO', 'NO HALLADO']
+    with open(path, 'w', encoding='latin-1') as f:
+        f.write('RUC|NOMBRE O RAZÓN SOCIAL|ESTADO DEL CONTRIBUYENTE|CONDICIÓN DE DOMICILIO|'
+                'UBIGEO|TIPO DE VÍA|NOMBRE DE VÍA|\n')
+        f.writelines(
+            '{}|EMPRESA {} S.A.C.|{}|{}|150101|AV.|LOS ÁLAMOS|\n'.format(
+                10000000000 + index * 7, index, estados[index % 5], condiciones[index % 4])
+            for index in range(rows)
+        )
+
+
+def bench_padron(args):
+    """
+    Padrón reducido: import time of a synthetic file and lookup latency
+    """
+    import random
+    from ConsultaSunat.padron import Padron, import_padron
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        infile = os.path.join(tmpdir, 'padron_reducido_ruc.txt')
+        database = os.path.join(tmpdir, 'padron.sqlite3')
+        write_padron(infile, args.rows)
+
+        start = time.perf_counter()
+        imported, skipped = import_padron(infile, database)
+        elapsed = time.perf_counter() - start
+        print("{} rows imported in {:.1f} s ({:.0f} rows/s), {:.1f} MB file, {:.1f} MB database".format(
+            imported, elapsed, imported / elapsed,
+            os.path.getsize(infile) / 2 ** 20, os.path.getsize(database) / 2 ** 20))
+
+        padron = Padron(database)
+        found = [10000000000 + random.randrange(args.rows) * 7 for _ in range(args.number)]
+        missing = [ruc + 1 for ruc in found]
+        report('lookup, found', timeit.timeit(lambda: [padron.get(ruc) for ruc in found], number=1), args.number)
+        report('lookup, missing', timeit.timeit(lambda: [padron.get(ruc) for ruc in missing], number=1), args.number)
+        padron.close()
+
+
+def argparse_setup():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = arg_parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    parser = subparsers.add_parser('captcha-capture', help=bench_captcha_capture.__doc__.strip().splitlines()[0])
+    parser.add_argument('--width', type=int, default=1024)
+    parser.add_argument('--height', type=int, default=1500)
+    parser.add_argument('-n', '--number', type=int, default=50)
+    parser.set_defaults(func=bench_captcha_capture)
+
+    parser = subparsers.add_parser('parse', help=bench_parse.__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        'pages',
+        nargs='*',
+        help='Saved result pages (frameResultadoBusqueda). Default: fixtures/resultado-*.html'
+    )
+    parser.add_argument('--encoding', default='utf-8')
+    parser.add_argument('-n', '--number', type=int, default=20)
+    parser.set_defaults(func=bench_parse)
+
+    parser = subparsers.add_parser('validate', help=bench_validate.__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=10 ** 6, help='Number of random RUCs')
+    parser.add_argument('-n', '--number', type=int, default=1)
+    parser.set_defaults(func=bench_validate)
+
+    parser = subparsers.add_parser('records', help=bench_records.__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=100000, help='Number of records')
+    parser.set_defaults(func=bench_records)
+
+    parser = subparsers.add_parser('serialize', help=bench_serialize.__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=100000, help='Number of records')
+    parser.add_argument('-n', '--number', type=int, default=1)
+    parser.set_defaults(func=bench_serialize)
+
+    parser = subparsers.add_parser('ocr', help=bench_ocr.__doc__.strip().splitlines()[0])
+    parser.add_argument('samples', help='Directory with captcha images')
+    parser.add_argument('--workers', type=int, default=4, help='Worker threads')
+    parser.add_argument('--processes', type=int, default=4, help='OCR worker processes')
+    parser.add_argument('-n', '--number', type=int, default=1)
+    parser.set_defaults(func=bench_ocr)
+
+    parser = subparsers.add_parser('padron', help=bench_padron.__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=3 * 10 ** 6, help='Rows of the synthetic padrón')
+    parser.add_argument('-n', '--number', type=int, default=100000, help='Lookups')
+    parser.set_defaults(func=bench_padron)
+
+    parser = subparsers.add_parser(
+        'e2e',
+        help=bench_e2e.__doc__.strip().splitlines()[0],
+        parents=[fake_sunat.argparse_setup(add_help=False)],
+        conflict_handler='resolve'
+    )
+    parser.add_argument('--rucs', type=int, default=100, help='Number of RUCs to query')
+    parser.add_argument('--engine', choices=['browser', 'http'], default='http')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=0, help='Port of the fake server. Default: any free port')
+    parser.add_argument('options', nargs=argparse.REMAINDER, help='More consulta.py options')
+    parser.set_defaults(func=bench_e2e)
+
+    return arg_parser
+
+
+def main(argv=None):
+    args = argparse_setup().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+
+class ResultCache:
+    """
+    On-disk cache of query results keyed by RUC.
+    Basic data (nombre, estado, condicion, CIIU...) and extended data
+    (deuda coactiva, omision tributaria) are stored with their own fetch
+    timestamp so each one can expire independently. Basic entries are
+    the Contribuyente records returned by Sunat and extended entries dicts
+    of the extended fields, both serialized with pickle so the model
+    objects in utils are restored as they were. Entries stored as dicts
+    by older versions are converted to records by Sunat when read
+    """
+    filename = 'sunat-cache.sqlite3'
+
+    def __init__(self, cache_dir, max_age=24 * 3600, max_age_extended=None,
+                 refresh=False):
+        """
+        max_age and max_age_extended are given in seconds. If refresh is
+        set, cached values are never returned but new results are stored
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, self.filename)
+        self.max_age = max_age
+        self.max_age_extended = max_age if max_age_extended is None else max_age_extended
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'ruc INTEGER PRIMARY KEY, '
+                'basic BLOB, basic_fetched REAL, '
+                'extended BLOB, extended_fetched REAL)'
+            )
+
+    def get(self, ruc):
+        """
+        Returns a (basic_data, extended_data) tuple, any of them is None
+        when it is missing or older than its max age
+        """
+        if self.refresh:
+            return None, None
+
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT basic, basic_fetched, extended, extended_fetched '
+                'FROM results WHERE ruc = ?',
+                (int(ruc),)
+            ).fetchone()
+        if row is None:
+            return None, None
+
+        basic, basic_fetched, extended, extended_fetched = row
+        now = time.time()
+        basic_data = None
+        if basic is not None and now - basic_fetched <= self.max_age:
+            basic_data = pickle.loads(basic)
+        ext_data = None
+        if extended is not None and now - extended_fetched <= self.max_age_extended:
+            ext_data = pickle.loads(extended)
+        return basic_data, ext_data
+
+    def put_basic(self, ruc, data):
+        self._put(ruc, 'basic', data)
+
+    def put_extended(self, ruc, data):
+        self._put(ruc, 'extended', data)
+
+    def _put(self, ruc, kind, data):
+        blob = sqlite3.Binary(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+        query = (
+            'INSERT INTO results (ruc, {kind}, {kind}_fetched) VALUES (?, ?, ?) '
+            'ON CONFLICT(ruc) DO UPDATE SET '
+            '{kind} = excluded.{kind}, {kind}_fetched = excluded.{kind}_fetched'
+        ).format(kind=kind)
+        with self.lock, self.conn:
+            self.conn.execute(query, (int(ruc), blob, time.time()))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
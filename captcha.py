@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+"""
+Captcha solver for the SUNAT search form.
+The captcha is made of 4 uppercase letters. Images are cleaned up with
+Pillow before being read, first by a template classifier (NumPy, runs in
+process) when templates are available and then by the OCR tool.
+Reading can be moved to a pool of OCR worker processes, so OCR runs on
+other cores while the worker threads keep loading pages
+"""
+from PIL import Image, ImageFilter, ImageOps
+import numpy
+import pyocr
+import pyocr.builders
+import argparse
+import io
+import logging
+import os
+import string
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+CAPTCHA_LENGTH = 4
+CAPTCHA_ALPHABET = string.ascii_uppercase
+
+DEFAULT_SETTINGS = {
+    # Pixels darker than this are considered text
+    'threshold': 140,
+    # Size of the median filter used to remove noise, 0 to disable
+    'denoise': 3,
+    # Scale factor applied after cropping, tesseract reads bigger text better
+    'scale': 2,
+}
+
+_ocr_tool = None
+_ocr_lock = threading.Lock()
+
+
+def get_ocr_tool():
+    """
+    Looks for an OCR tool only once per process. The in-process
+    libtesseract binding is preferred over the tesseract executable
+    """
+    global _ocr_tool
+    with _ocr_lock:
+        if _ocr_tool is None:
+            tools = pyocr.get_available_tools()
+            if len(tools) == 0:
+                raise ValueError("No OCR tool found")
+            in_process = [tool for tool in tools if tool.__name__.endswith('libtesseract')]
+            _ocr_tool = in_process[0] if in_process else tools[0]
+    return _ocr_tool
+
+
+def preprocess(image, settings=None):
+    """
+    Returns a binarized (black text over white background) copy of image,
+    without noise and cropped to the text
+    """
+    settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+
+    img = image.convert('L')
+    if settings['denoise']:
+        img = img.filter(ImageFilter.MedianFilter(settings['denoise']))
+    threshold = settings['threshold']
+    img = img.point(lambda p: 255 if p > threshold else 0)
+
+    bbox = ImageOps.invert(img).getbbox()
+    if bbox is not None:
+        left, top, right, bottom = bbox
+        margin = 2
+        img = img.crop((
+            max(left - margin, 0),
+            max(top - margin, 0),
+            min(right + margin, img.width),
+            min(bottom + margin, img.height)
+        ))
+
+    scale = settings['scale']
+    if scale != 1:
+        img = img.resize((img.width * scale, img.height * scale), Image.NEAREST)
+    return img
+
+
+def clean_text(text):
+    return ''.join(c for c in text.upper() if c in CAPTCHA_ALPHABET)
+
+
+class TemplateClassifier:
+    """
+    Nearest neighbour classifier over fixed size glyph bitmaps.
+    Glyphs are separated using the columns without text
+    """
+    glyph_size = (16, 20)
+
+    def __init__(self, labels=None, templates=None):
+        self.labels = list(labels or [])
+        width, height = self.glyph_size
+        if templates is None:
+            templates = numpy.zeros((0, width * height), dtype=numpy.float32)
+        self.templates = templates
+
+    @classmethod
+    def load(cls, path):
+        with numpy.load(path) as data:
+            return cls(list(data['labels']), data['templates'])
+
+    def save(self, path):
+        numpy.savez_compressed(
+            path,
+            labels=numpy.array(self.labels),
+            templates=self.templates
+        )
+
+    def __len__(self):
+        return len(self.labels)
+
+    def get_glyphs(self, image):
+        """
+        Splits a preprocessed image in CAPTCHA_LENGTH glyphs.
+        Returns an empty list if it can't be done
+        """
+        ink = numpy.asarray(image.convert('L')) < 128
+        columns = ink.any(axis=0)
+
+        # Runs of consecutive columns with text
+        runs = []
+        start = None
+        for index, has_ink in enumerate(columns):
+            if has_ink and start is None:
+                start = index
+            elif not has_ink and start is not None:
+                runs.append([start, index])
+                start = None
+        if start is not None:
+            runs.append([start, len(columns)])
+
+        # Merge the closest runs when a glyph was broken in pieces
+        while len(runs) > CAPTCHA_LENGTH:
+            gaps = [runs[i + 1][0] - runs[i][1] for i in range(len(runs) - 1)]
+            i = gaps.index(min(gaps))
+            runs[i:i + 2] = [[runs[i][0], runs[i + 1][1]]]
+        # Split the widest run when glyphs touch each other
+        while 0 < len(runs) < CAPTCHA_LENGTH:
+            widths = [end - begin for begin, end in runs]
+            i = widths.index(max(widths))
+            begin, end = runs[i]
+            if end - begin < 2:
+                return []
+            middle = (begin + end) // 2
+            runs[i:i + 1] = [[begin, middle], [middle, end]]
+        if not runs:
+            return []
+
+        glyphs = []
+        for begin, end in runs:
+            glyph = ink[:, begin:end]
+            rows = numpy.flatnonzero(glyph.any(axis=1))
+            glyph = glyph[rows[0]:rows[-1] + 1]
+            glyph_img = Image.fromarray((glyph * 255).astype(numpy.uint8))
+            glyph_img = glyph_img.resize(self.glyph_size, Image.BILINEAR)
+            glyphs.append(numpy.asarray(glyph_img, dtype=numpy.float32).ravel() / 255)
+        return glyphs
+
+    def train(self, samples):
+        """
+        Adds the glyphs of samples, an iterable of (preprocessed image, text)
+        pairs. Returns the number of samples used
+        """
+        labels = []
+        templates = []
+        for image, text in samples:
+            glyphs = self.get_glyphs(image)
+            if len(glyphs) != len(text):
+                continue
+            labels.extend(text)
+            templates.extend(glyphs)
+
+        if templates:
+            self.labels.extend(labels)
+            self.templates = numpy.vstack([self.templates, numpy.array(templates)])
+        return len(templates) // CAPTCHA_LENGTH
+
+    def classify(self, image):
+        if not self.labels:
+            return ''
+        glyphs = self.get_glyphs(image)
+        if not glyphs:
+            return ''
+        glyphs = numpy.array(glyphs)
+        # Squared distance between every glyph and every template
+        distances = (
+            (glyphs ** 2).sum(axis=1)[:, numpy.newaxis] -
+            2 * glyphs.dot(self.templates.T) +
+            (self.templates ** 2).sum(axis=1)[numpy.newaxis, :]
+        )
+        return ''.join(self.labels[i] for i in distances.argmin(axis=1))
+
+
+def to_png(image):
+    """
+    Captchas are sent to the OCR workers as PNG bytes
+    """
+    if isinstance(image, bytes):
+        return image
+    output = io.BytesIO()
+    image.save(output, 'PNG')
+    return output.getvalue()
+
+
+# Solver of an OCR worker process, created by init_ocr_worker
+_worker_solver = None
+
+
+def init_ocr_worker(classifier, settings):
+    global _worker_solver
+    _worker_solver = CaptchaSolver(logging.getLogger('sunat'), classifier, settings)
+
+
+def ocr_png(png):
+    """
+    Runs in an OCR worker. Returns the text of a PNG encoded captcha and
+    the seconds spent reading it
+    """
+    start = time.perf_counter()
+    with Image.open(io.BytesIO(png)) as image:
+        text = _worker_solver.read(preprocess(image, _worker_solver.settings))
+    return text, time.perf_counter() - start
+
+
+class CaptchaSolver:
+    """
+    Reads captcha images and keeps statistics about solve latency and how
+    many of the answers were accepted by SUNAT. Safe to share between threads.
+    With processes > 0 captchas are read by that many OCR worker processes
+    and the calling thread only waits for the answer.
+    Every attempt is recorded in log (a telemetry.CaptchaLog) if given
+    """
+    def __init__(self, logger, classifier=None, settings=None, processes=0,
+                 log=None):
+        self.logger = logger
+        self.classifier = classifier
+        self.settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+        self.lock = threading.Lock()
+        self.attempts = 0
+        self.valid_reads = 0
+        self.accepted = 0
+        self.rejected = 0
+        # Searches done with an already accepted captcha
+        self.reused = 0
+        self.total_time = 0.0
+        self.executor = None
+        if processes > 0:
+            self.executor = ProcessPoolExecutor(
+                max_workers=processes,
+                initializer=init_ocr_worker,
+                initargs=(classifier, self.settings)
+            )
+        # Captchas waiting for or being read by an OCR worker
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        # Time spent by captchas in the queue, before a worker reads them
+        self.queue_time = 0.0
+        self.log = log
+        # Logged attempt of each thread waiting for report()
+        self.pending = threading.local()
+
+    def read(self, image):
+        if self.classifier is not None and len(self.classifier):
+            text = self.classifier.classify(image)
+            if len(text) == CAPTCHA_LENGTH:
+                return text
+
+        builder = pyocr.builders.TextBuilder(tesseract_layout=8)
+        return clean_text(get_ocr_tool().image_to_string(image, builder=builder))
+
+    def read_in_worker(self, png):
+        """
+        Sends a PNG encoded captcha to the OCR workers and waits for the
+        text. Returns the text and the seconds it waited in the queue
+        """
+        with self.lock:
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        start = time.perf_counter()
+        try:
+            text, ocr_time = self.executor.submit(ocr_png, png).result()
+        finally:
+            with self.lock:
+                self.queue_depth -= 1
+        return text, time.perf_counter() - start - ocr_time
+
+    def solve(self, image):
+        start = time.perf_counter()
+        queue_time = 0.0
+        png = None
+        if self.executor is not None or self.log is not None:
+            png = to_png(image)
+        if self.executor is None:
+            if isinstance(image, bytes):
+                image = Image.open(io.BytesIO(image))
+            text = self.read(preprocess(image, self.settings))
+        else:
+            text, queue_time = self.read_in_worker(png)
+        elapsed = time.perf_counter() - start
+
+        if self.log is not None:
+            self.pending.attempt = self.log.record(png, text, self.settings, elapsed)
+
+        with self.lock:
+            self.attempts += 1
+            self.total_time += elapsed
+            self.queue_time += queue_time
+            if len(text) == CAPTCHA_LENGTH:
+                self.valid_reads += 1
+        self.logger.debug("Captcha read as '%s' in %.3f seconds", text, elapsed)
+        return text
+
+    def report(self, accepted):
+        """
+        Records whether SUNAT accepted the last answer sent
+        """
+        attempt = getattr(self.pending, 'attempt', None)
+        if attempt is not None:
+            self.pending.attempt = None
+            self.log.set_accepted(attempt, accepted)
+        with self.lock:
+            if accepted:
+                self.accepted += 1
+            else:
+                self.rejected += 1
+
+    def report_reuse(self):
+        """
+        Records a search answered with a captcha accepted before
+        """
+        with self.lock:
+            self.reused += 1
+
+    def summary(self):
+        with self.lock:
+            submitted = self.accepted + self.rejected
+            summary = (
+                "Captcha: {attempts} read in {avg:.3f} s on average, "
+                "{valid} with valid length, {accepted}/{submitted} accepted ({rate:.1%})"
+            ).format(
+                attempts=self.attempts,
+                avg=self.total_time / self.attempts if self.attempts else 0,
+                valid=self.valid_reads,
+                accepted=self.accepted,
+                submitted=submitted,
+                rate=self.accepted / submitted if submitted else 0
+            )
+            if self.reused:
+                summary += (
+                    ". {reused} searches reused a captcha, {per_captcha:.1f} searches per captcha read"
+                ).format(
+                    reused=self.reused,
+                    per_captcha=(self.accepted + self.reused) / self.attempts if self.attempts else 0
+                )
+            if self.executor is not None:
+                summary += (
+                    ". OCR queue: {wait:.3f} s average wait, max depth {depth}"
+                ).format(
+                    wait=self.queue_time / self.attempts if self.attempts else 0,
+                    depth=self.max_queue_depth
+                )
+            return summary
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def load_samples(samples_dir):
+    """
+    Reads labelled captcha images, the answer must be the first
+    CAPTCHA_LENGTH characters of the file name (e.g. ABCD.png, ABCD-1.png)
+    """
+    for filename in sorted(os.listdir(samples_dir)):
+        text = clean_text(os.path.splitext(filename)[0])[:CAPTCHA_LENGTH]
+        if len(text) != CAPTCHA_LENGTH:
+            continue
+        with Image.open(os.path.join(samples_dir, filename)) as image:
+            image.load()
+            yield image, text
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        description="Train and evaluate the captcha template classifier"
+    )
+    arg_parser.add_argument('samples', help='Directory with labelled captcha images')
+    arg_parser.add_argument('templates', help='Templates file (.npz) to create')
+    arg_parser.add_argument(
+        '--evaluate',
+        help='Directory with labelled captcha images to measure accuracy and latency with'
+    )
+    args = arg_parser.parse_args(argv)
+
+    classifier = TemplateClassifier()
+    used = classifier.train(
+        (preprocess(image), text) for image, text in load_samples(args.samples)
+    )
+    classifier.save(args.templates)
+    print("{} samples used, {} glyph templates saved to {}".format(
+        used, len(classifier), args.templates))
+
+    if args.evaluate:
+        solver = CaptchaSolver(logging.getLogger('sunat'), classifier)
+        for image, text in load_samples(args.evaluate):
+            solver.report(solver.solve(image) == text)
+        print(solver.summary())
+
+
+if __name__ == '__main__':
+    main()
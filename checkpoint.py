@@ -0,0 +1,70 @@
+import os
+
+
+class Checkpoint:
+    """
+    State of a batch run: one line per finished RUC ("done <ruc>" or
+    "failed <ruc>") appended as soon as the RUC finishes, so the run can
+    be resumed after a crash
+    """
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.done = set()
+        self.failed = set()
+        complete = True
+        if resume and os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    # The last line may be incomplete if the previous run crashed
+                    complete = line.endswith('\n')
+                    if complete:
+                        self.load_line(line)
+        self.file = open(path, 'a' if resume else 'w')
+        if not complete:
+            self.file.write('\n')
+
+    def load_line(self, line):
+        tokens = line.split()
+        if len(tokens) != 2 or not tokens[1].isdigit():
+            return
+        status, ruc = tokens[0], int(tokens[1])
+        if status == 'done':
+            self.done.add(ruc)
+            self.failed.discard(ruc)
+        elif status == 'failed':
+            self.failed.add(ruc)
+
+    def mark(self, ruc, ok):
+        if ok:
+            self.done.add(ruc)
+            self.failed.discard(ruc)
+        else:
+            self.failed.add(ruc)
+        self.file.write('{} {}\n'.format('done' if ok else 'failed', ruc))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def open_results_file(path, resume=False):
+    """
+    Opens a JSON Lines results file for appending. When resuming, a last
+    line left incomplete by a crash is removed; its RUC was not marked as
+    done in the checkpoint so it will be queried again
+    """
+    if not resume or not os.path.isfile(path):
+        return open(path, 'w')
+
+    with open(path, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        end = size
+        while end > 0:
+            f.seek(end - 1)
+            if f.read(1) == b'\n':
+                break
+            end -= 1
+        if end != size:
+            f.truncate(end)
+    return open(path, 'a')
@@ -1,16 +1,30 @@
 #!/usr/bin/env python3
 import sys
 from selenium import webdriver
+import requests
 import contextlib
 import logging
 import logging.config
 import argparse
+import itertools
 import json
 import os
+import time
 
 sys.path.append("..")
-from ConsultaSunat.sunat import Sunat, InvalidRUCError
-from ConsultaSunat.utils import CustomJSONEncoder
+from ConsultaSunat.sunat import Sunat, ALL_FIELDS, EXTENDED_FIELDS, check_fields
+from ConsultaSunat.sunat_http import SunatHTTP
+from ConsultaSunat.cache import ResultCache
+from ConsultaSunat.padron import Padron
+from ConsultaSunat.captcha import CaptchaSolver, TemplateClassifier
+from ConsultaSunat.telemetry import CaptchaLog
+from ConsultaSunat.pool import ResourcePool
+from ConsultaSunat.retry import RetryScheduler, RetryPolicy, default_policies
+from ConsultaSunat.ratelimit import RateLimiter
+from ConsultaSunat.metrics import Metrics
+from ConsultaSunat.checkpoint import Checkpoint, open_results_file
+from ConsultaSunat.snapshot import Snapshot
+from ConsultaSunat.utils import dumps, write_jsonl
 
 
 dir_path = os.path.dirname(os.path.realpath(__file__)) + '/'
@@ -18,11 +32,15 @@ logging.config.fileConfig(dir_path + 'logging.conf')
 logger = logging.getLogger('sunat')
 
 
-def argparse_setup():
+def argparse_setup(require_rucs=True):
+    """
+    With require_rucs=False the parser only reads the query options, for
+    callers passing the RUCs to query_rucs
+    """
     arg_parser = argparse.ArgumentParser(
         description="Get RUC information through SUNAT"
     )
-    group = arg_parser.add_mutually_exclusive_group(required=True)
+    group = arg_parser.add_mutually_exclusive_group(required=require_rucs)
     group.add_argument(
         '--ruc',
         nargs='+',
@@ -38,7 +56,27 @@ def argparse_setup():
         '--retries',
         type=int,
         default=-1,
-        help='Limit number of retries. Default: try until successful'
+        help='Maximum attempts per RUC, the first one included (0 and 1 both mean a single '
+             'attempt without retries). Default: try until successful'
+    )
+    arg_parser.add_argument(
+        '--retry-budget',
+        type=int,
+        default=-1,
+        help='Limit number of retries for the whole batch, extended information '
+             'included. Default: no limit'
+    )
+    arg_parser.add_argument(
+        '--backoff',
+        type=float,
+        default=1,
+        help='Initial wait in seconds before retrying after a timeout or site error. Default: 1'
+    )
+    arg_parser.add_argument(
+        '--max-backoff',
+        type=float,
+        default=60,
+        help='Maximum wait in seconds before retrying. Default: 60'
     )
     arg_parser.add_argument(
         '-o',
@@ -46,6 +84,164 @@ def argparse_setup():
         default='sunat-results.txt',
         help='Where to save the results'
     )
+    arg_parser.add_argument(
+        '--format',
+        choices=['json', 'jsonl'],
+        default='json',
+        help='json writes all results at the end, jsonl appends one line per RUC '
+             'as it completes and keeps a checkpoint file. Default: json'
+    )
+    arg_parser.add_argument(
+        '--compact',
+        action='store_true',
+        help='Write the json output without indentation'
+    )
+    arg_parser.add_argument(
+        '--snapshot',
+        metavar='FILE',
+        help='Delta mode: compare every result with the last one saved in FILE (SQLite) and '
+             'write only the RUCs that changed, with the changed fields and their previous '
+             'values. RUCs that changed more often in previous runs are queried first'
+    )
+    arg_parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Skip RUCs already completed according to the checkpoint of a previous jsonl run'
+    )
+    arg_parser.add_argument(
+        '--engine',
+        choices=['browser', 'http'],
+        default='browser',
+        help='Query SUNAT through PhantomJS or plain HTTP requests. Default: browser'
+    )
+    arg_parser.add_argument(
+        '--base-url',
+        metavar='URL',
+        help='Query another server instead of SUNAT, e.g. fake_sunat.py: http://localhost:8000'
+    )
+    arg_parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of RUCs queried concurrently, each worker with its own browser or session. Default: 1'
+    )
+    arg_parser.add_argument(
+        '--async-extended',
+        type=int,
+        default=0,
+        metavar='N',
+        help='Fetch extended information (deuda coactiva, omision tributaria) '
+             'asynchronously after the basic queries, with at most N RUCs in flight'
+    )
+    arg_parser.add_argument(
+        '--cache-dir',
+        help='Directory of the on-disk results cache. Default: no cache'
+    )
+    arg_parser.add_argument(
+        '--max-age',
+        type=float,
+        default=24,
+        help='Hours a cached result is considered fresh. Default: 24'
+    )
+    arg_parser.add_argument(
+        '--max-age-extended',
+        type=float,
+        help='Hours cached extended information is considered fresh. Default: same as --max-age'
+    )
+    arg_parser.add_argument(
+        '--refresh',
+        action='store_true',
+        help='Query every RUC again, ignoring (but updating) the cache'
+    )
+    arg_parser.add_argument(
+        '--padron',
+        metavar='FILE',
+        help='Padrón reducido database (created with padron.py)'
+    )
+    arg_parser.add_argument(
+        '--fields',
+        type=lambda value: [field.strip() for field in value.split(',') if field.strip()],
+        help='Comma separated fields to get, the stages that only give other fields are '
+             'skipped, e.g. ruc,nombre,estado,condicion can be answered by --padron alone. '
+             'Fields: {}. Default: all'.format(','.join(ALL_FIELDS))
+    )
+    arg_parser.add_argument(
+        '--captcha-templates',
+        help='Glyph templates file (created with captcha.py) used to read captchas without OCR'
+    )
+    arg_parser.add_argument(
+        '--captcha-settings',
+        metavar='FILE',
+        help='JSON file with the captcha preprocessing settings, as saved by telemetry.py --save'
+    )
+    arg_parser.add_argument(
+        '--captcha-log',
+        metavar='FILE',
+        help='SQLite file where every captcha read is recorded (image, text, settings, latency '
+             'and whether SUNAT accepted it), to be analyzed with telemetry.py'
+    )
+    arg_parser.add_argument(
+        '--reuse-captcha',
+        action='store_true',
+        help='Keep searching with the last accepted captcha of each session until SUNAT '
+             'rejects it, instead of reading a new one for every RUC'
+    )
+    arg_parser.add_argument(
+        '--ocr-processes',
+        type=int,
+        default=0,
+        metavar='N',
+        help='Read captchas in N OCR worker processes while the workers keep loading pages. '
+             'Default: 0 (read in the worker thread)'
+    )
+    arg_parser.add_argument(
+        '--parser',
+        choices=['bs4', 'lxml'],
+        default='bs4',
+        help='Parser for the result page, lxml skips building a BeautifulSoup tree. Default: bs4'
+    )
+    arg_parser.add_argument(
+        '--recycle-after',
+        type=int,
+        default=100,
+        metavar='K',
+        help='Replace a browser or session after K queries. Default: 100'
+    )
+    arg_parser.add_argument(
+        '--max-timeouts',
+        type=int,
+        default=3,
+        help='Replace a browser after this many consecutive page load timeouts. Default: 3'
+    )
+    arg_parser.add_argument(
+        '--rate',
+        type=float,
+        default=0,
+        help='Initial requests per second sent to SUNAT by all workers together. '
+             'Adapts to errors and timeouts. Default: no limit'
+    )
+    arg_parser.add_argument(
+        '--min-rate',
+        type=float,
+        default=0.1,
+        help='Lowest requests per second when adapting the rate. Default: 0.1'
+    )
+    arg_parser.add_argument(
+        '--max-rate',
+        type=float,
+        help='Highest requests per second when adapting the rate. Default: 4 times --rate'
+    )
+    arg_parser.add_argument(
+        '--metrics',
+        action='store_true',
+        help='Time every stage of the queries and log p50/p95/p99 latencies at the end'
+    )
+    arg_parser.add_argument(
+        '--metrics-file',
+        metavar='FILE',
+        help='Save the stage latencies to FILE, as JSON if it ends with .json and in '
+             'Prometheus text format otherwise. Implies --metrics'
+    )
 
     return arg_parser
 
@@ -56,56 +252,345 @@ def browse(driver):
     driver.quit()
 
 
+def open_sunat(engine, **kwargs):
+    if engine == 'http':
+        return SunatHTTP(requests.Session(), logger, **kwargs)
+    driver = webdriver.PhantomJS()
+    driver.set_page_load_timeout(5)
+    return Sunat(driver, logger, **kwargs)
+
+
+def create_pool(args, **sunat_kwargs):
+    """
+    Pool of Sunat instances, each one with its own driver or HTTP session
+    """
+    return ResourcePool(
+        lambda: open_sunat(args.engine, **sunat_kwargs),
+        lambda sunat: sunat.close(),
+        args.workers,
+        logger,
+        max_uses=args.recycle_after,
+        health_check=lambda sunat: sunat.is_healthy(args.max_timeouts)
+    )
+
+
+def add_extended_information(all_data, max_concurrency, scheduler, policy, cache=None,
+                             rate_limiter=None, metrics=None, base_url=None,
+                             fields=EXTENDED_FIELDS):
+    """
+    Completes the basic data with the extended fields, querying every
+    RUC concurrently. Failed RUCs are queried again after the backoff of
+    policy, taking their retries from the budget of scheduler. Records
+    whose extended information could not be fetched are discarded
+    """
+    sunat = Sunat(None, logger, rate_limiter=rate_limiter, metrics=metrics, base_url=base_url)
+    # Records found in the cache may already have their extended data
+    pending = [data for data in all_data if not all(field in data for field in fields)]
+    max_retries = scheduler.max_retries
+    exhausted = []
+    num_retries = 0
+    while pending:
+        if num_retries:
+            delay = policy.delay(num_retries)
+            logger.info("Retrying extended information of %d RUCs in %.1fs", len(pending), delay)
+            time.sleep(delay)
+        num_retries += 1
+        items = [(data.ruc, data.nombre) for data in pending]
+        results = sunat.get_extended_information_batch(items, max_concurrency, fields)
+
+        failed = []
+        for data, ext_data in zip(pending, results):
+            if ext_data is None:
+                failed.append(data)
+            else:
+                data.update(ext_data)
+                if cache is not None:
+                    cache.put_extended(data.ruc, {
+                        field: getattr(data, field) for field in EXTENDED_FIELDS if field in data
+                    })
+        pending = []
+        # At least one attempt, as for the basic queries
+        if max_retries != -1 and num_retries >= max(max_retries, 1):
+            exhausted.extend(failed)
+            break
+        for data in failed:
+            if scheduler.use_retry():
+                pending.append(data)
+            else:
+                exhausted.append(data)
+
+    for data in exhausted:
+        logger.error("Extended information request for RUC: %d failed", data.ruc)
+    failed_ids = set(id(data) for data in exhausted)
+    return [data for data in all_data if id(data) not in failed_ids]
+
+
+def with_extended_information(results, max_concurrency, scheduler, policy, cache=None,
+                              rate_limiter=None, metrics=None, base_url=None,
+                              fields=EXTENDED_FIELDS):
+    """
+    Adds the extended information to the (index, ruc, data) query results,
+    querying it concurrently for a chunk of results at a time. Records whose
+    extended information could not be fetched are returned as failed
+    """
+    chunk_size = max_concurrency * 10
+    while True:
+        chunk = list(itertools.islice(results, chunk_size))
+        if not chunk:
+            return
+        completed = add_extended_information(
+            [data for index, ruc, data in chunk if data],
+            max_concurrency, scheduler, policy, cache, rate_limiter, metrics, base_url, fields
+        )
+        completed_ids = set(id(data) for data in completed)
+        for index, ruc, data in chunk:
+            yield index, ruc, data if id(data) in completed_ids else None
+
+
+def keep_fields(results, fields):
+    """
+    Drops the fields not requested from the (index, ruc, data) query results
+    """
+    for index, ruc, data in results:
+        if data:
+            data.keep(fields)
+        yield index, ruc, data
+
+
+def check_options(args):
+    if args.workers < 1:
+        raise ValueError("--workers must be at least 1")
+    if args.recycle_after < 1:
+        raise ValueError("--recycle-after must be at least 1")
+    if args.async_extended < 0:
+        raise ValueError("--async-extended must not be negative")
+    if args.resume and args.format != 'jsonl':
+        raise ValueError("--resume requires --format jsonl")
+    if args.ocr_processes < 0:
+        raise ValueError("--ocr-processes must not be negative")
+    if args.fields is not None:
+        check_fields(args.fields)
+
+
+def query_rucs(rucs, args=None):
+    """
+    Queries SUNAT for every RUC in rucs, an iterable that is consumed
+    lazily. Yields (index, ruc, data) tuples as each RUC finishes, in
+    completion order; data is a Contribuyente, None if the query failed.
+    args are the options returned by argparse_setup(require_rucs=False),
+    defaults are used if not given
+    """
+    if args is None:
+        args = argparse_setup(require_rucs=False).parse_args([])
+    check_options(args)
+    fields = ALL_FIELDS if args.fields is None else args.fields
+    ext_fields = [field for field in EXTENDED_FIELDS if field in fields]
+    extended = args.async_extended == 0
+    query_fields = fields
+    if not extended and ext_fields and 'nombre' not in fields:
+        # nombre is a parameter of the extended requests made later
+        query_fields = list(fields) + ['nombre']
+
+    cache = None
+    if args.cache_dir:
+        max_age_extended = args.max_age if args.max_age_extended is None else args.max_age_extended
+        cache = ResultCache(
+            args.cache_dir,
+            max_age=args.max_age * 3600,
+            max_age_extended=max_age_extended * 3600,
+            refresh=args.refresh
+        )
+
+    rate_limiter = None
+    if args.rate > 0:
+        rate_limiter = RateLimiter(args.rate, min_rate=args.min_rate, max_rate=args.max_rate)
+
+    padron = None
+    if args.padron:
+        padron = Padron(args.padron)
+
+    metrics = None
+    if args.metrics or args.metrics_file:
+        metrics = Metrics()
+
+    classifier = None
+    if args.captcha_templates:
+        classifier = TemplateClassifier.load(args.captcha_templates)
+    captcha_settings = None
+    if args.captcha_settings:
+        with open(args.captcha_settings) as f:
+            captcha_settings = json.load(f)
+    captcha_log = None
+    if args.captcha_log:
+        captcha_log = CaptchaLog(args.captcha_log)
+    # Shared by every worker so the statistics cover the whole run
+    captcha_solver = CaptchaSolver(
+        logger,
+        classifier,
+        captcha_settings,
+        processes=args.ocr_processes,
+        log=captcha_log
+    )
+
+    with contextlib.ExitStack() as stack:
+        if captcha_log is not None:
+            stack.callback(captcha_log.close)
+        if padron is not None:
+            stack.callback(padron.close)
+        stack.callback(captcha_solver.close)
+        # Callbacks run in reverse order, the OCR queue stats are only
+        # there until the solver is closed
+        stack.callback(lambda: logger.info(captcha_solver.summary()))
+        if cache is not None:
+            stack.callback(cache.close)
+
+        pool = stack.enter_context(contextlib.closing(create_pool(
+            args,
+            cache=cache,
+            captcha_solver=captcha_solver,
+            parser=args.parser,
+            raise_errors=True,
+            rate_limiter=rate_limiter,
+            metrics=metrics,
+            base_url=args.base_url,
+            reuse_captcha=args.reuse_captcha,
+            padron=padron
+        )))
+        pool.prewarm()
+
+        def query(ruc):
+            with pool.resource() as sunat:
+                return sunat.get_all_information(ruc, extended, query_fields)
+
+        # The extended phase shares the retry budget of the basic queries
+        scheduler = RetryScheduler(
+            query,
+            logger,
+            workers=args.workers,
+            max_retries=args.retries,
+            budget=args.retry_budget,
+            policies=default_policies(args.backoff, args.max_backoff)
+        )
+        results = scheduler.run(rucs)
+        if not extended and ext_fields:
+            policy = RetryPolicy('extended error', RetryPolicy.LATER, args.backoff, args.max_backoff)
+            results = with_extended_information(
+                results, args.async_extended, scheduler, policy, cache, rate_limiter, metrics,
+                args.base_url, ext_fields
+            )
+        if query_fields is not fields:
+            results = keep_fields(results, fields)
+        yield from results
+
+    if metrics is not None:
+        logger.info("Time per stage:\n%s", metrics.summary())
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+
+
+def delta_record(snapshot, ruc, data):
+    """
+    Returns the record written with --snapshot, None if nothing changed:
+    {"ruc", "changed": [fields], "previous": {field: value}, "data": data}.
+    previous is None for a RUC seen for the first time
+    """
+    changed, previous = snapshot.diff(ruc, data.to_dict())
+    if not changed:
+        return None
+    return {
+        'ruc': ruc,
+        'changed': changed,
+        'previous': previous,
+        'data': data,
+    }
+
+
 def main(argv=None):
+    """
+    Returns the list of results (Contribuyente records), or None with
+    --format jsonl since results are written to the output file as they
+    arrive and not kept in memory.
+    With --snapshot the results are the delta records of the RUCs that
+    changed
+    """
     arg_parser = argparse_setup()
     args = arg_parser.parse_args(argv)
 
     # User defined
     ruc_list = args.ruc
-    max_retries = args.retries
     outfile = args.outfile
 
     if args.test:
         ruc_list = [20331066703, 20141528069, 20159253539, 20217932565]
         outfile = 'sunat-search-test.txt'
 
-    all_data = []
-    with browse(webdriver.PhantomJS()) as driver:
-        driver.set_page_load_timeout(5)
-        sunat = Sunat(driver, logger)
-
-        for index, ruc in enumerate(ruc_list):
-            logger.info("Started request for RUC: %d (%d/%d)", ruc, index + 1, len(ruc_list))
-            retry = True
-            num_retries = 0
-            # If max_retries is not specified, the query is repeated until it succeeds
-            while retry and (max_retries == -1 or num_retries < max_retries):
-                num_retries += 1
-                try:
-                    data = sunat.get_all_information(ruc)
-                except InvalidRUCError as e:
-                    logger.error(e)
-                    data = None
-                    retry = False
-
-                if data:
-                    all_data.append(data)
-                    retry = False
-
-            if num_retries >= max_retries and max_retries != -1 and retry:
-                logger.error("Max number of retries reached. Request for RUC: %d failed", ruc)
-            elif not retry and not data:
-                logger.error("Request for RUC: %d failed", ruc)
-            else:
-                logger.info("Request for RUC %d completed successfully", ruc)
+    try:
+        check_options(args)
+    except ValueError as e:
+        arg_parser.error(str(e))
+
+    with contextlib.ExitStack() as stack:
+        snapshot = None
+        if args.snapshot:
+            snapshot = Snapshot(args.snapshot)
+            stack.callback(snapshot.close)
+            ruc_list = snapshot.prioritize(ruc_list)
 
-        with open(outfile, 'w') as f:
-            json.dump(all_data, f, ensure_ascii=False, indent=2, cls=CustomJSONEncoder)
+        checkpoint = None
+        pending = ruc_list
+        if args.format == 'jsonl':
+            # Results and progress are written as each RUC finishes
+            checkpoint = Checkpoint(outfile + '.checkpoint', resume=args.resume)
+            stack.callback(checkpoint.close)
+            pending = [ruc for ruc in ruc_list if ruc not in checkpoint.done]
+            if len(pending) < len(ruc_list):
+                logger.info("Resuming: %d of %d RUCs already completed", len(ruc_list) - len(pending), len(ruc_list))
+            out_file = stack.enter_context(open_results_file(outfile, args.resume))
 
-        if len(all_data) < len(ruc_list):
-            logger.info("Couldn't complete request for some or all RUC values. Results saved to: %s", outfile)
+        all_data = []
+        # With --format json the snapshot is updated once the file is written
+        checked = []
+        changes = 0
+        completed = len(ruc_list) - len(pending)
+        for index, ruc, data in query_rucs(pending, args):
+            if data:
+                completed += 1
+                record = data
+                if snapshot is not None:
+                    record = delta_record(snapshot, ruc, data)
+                    changes += record is not None
+                if checkpoint is None:
+                    if record is not None:
+                        all_data.append((index, record))
+                    if snapshot is not None:
+                        checked.append((ruc, data))
+                else:
+                    if record is not None:
+                        write_jsonl([record], out_file)
+                        out_file.flush()
+                    if snapshot is not None:
+                        snapshot.update(ruc, data.to_dict())
+            # Only marked as done after its result was written
+            if checkpoint is not None:
+                checkpoint.mark(ruc, bool(data))
+
+        if checkpoint is None:
+            # Same order as ruc_list
+            all_data = [data for index, data in sorted(all_data, key=lambda item: item[0])]
+            with open(outfile, 'w') as f:
+                f.write(dumps(all_data, indent=None if args.compact else 2))
+            for ruc, data in checked:
+                snapshot.update(ruc, data.to_dict())
         else:
-            logger.info("Request finished successfully. Results saved to: %s", outfile)
+            all_data = None
+
+    if snapshot is not None:
+        logger.info("%d RUCs changed since the previous snapshot", changes)
+
+    if completed < len(ruc_list):
+        logger.info("Couldn't complete request for some or all RUC values. Results saved to: %s", outfile)
+    else:
+        logger.info("Request finished successfully. Results saved to: %s", outfile)
 
     return all_data
 
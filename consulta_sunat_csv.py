@@ -6,39 +6,122 @@ import csv
 import itertools
 
 
+# consulta options about the input and output files, which are given as
+# arguments here
+UNSUPPORTED_OPTIONS = [
+    ('ruc', '--ruc'),
+    ('test', '--test'),
+    ('outfile', '-o/--outfile'),
+    ('format', '--format'),
+    ('compact', '--compact'),
+    ('resume', '--resume'),
+    ('snapshot', '--snapshot'),
+]
+
+
 def main(args=None):
+    """
+    args: [program, input file, output file, consulta options...]
+    RUCs are read lazily from the input file and every CSV row is written
+    as soon as its result arrives
+    """
     if args is None:
         args = sys.argv
 
-    if len(args) != 3:
+    if len(args) < 3:
         print("Incorrect number of arguments")
         return
     if not os.path.isfile(args[1]):
         print("Input file does not exist")
         return
 
-    ruc_list = []
-    with open(args[1], 'r') as input_file:
-        ruc_list = list(set(ruc.strip() for ruc in input_file if ruc.strip()))
+    arg_parser = consulta.argparse_setup(require_rucs=False)
+    options = arg_parser.parse_args(args[3:])
+    for dest, flag in UNSUPPORTED_OPTIONS:
+        if getattr(options, dest) != arg_parser.get_default(dest):
+            arg_parser.error("{} is not supported, the RUCs are read from {} and the results "
+                             "written to {}".format(flag, args[1], args[2]))
+    if options.fields is None:
+        # Only the columns of the CSV, no extended requests
+        options.fields = ['ruc', 'nombre', 'ciiu']
 
-    data = consulta.main(['--ruc'] + ruc_list)
-    with open(args[2], 'w') as out_file:
+    with open(args[1], 'r') as input_file, open(args[2], 'w') as out_file:
         writer = csv.writer(out_file)
         writer.writerow([
             "Nombre", "RUC", "CIIU", "Descripción", "Revision"
         ])
-        for ruc in data:
-            columns = [ruc['nombre'], ruc['ruc']]
-            for index, ciiu in enumerate(get_main_ciiu(ruc['ciiu'])):
-                cod_ciiu = str(ciiu.codigo)
-                cod_ciiu = cod_ciiu + '\\' if cod_ciiu.startswith('0') else cod_ciiu
-
-                columns.extend([
-                    cod_ciiu,
-                    ciiu.descripcion,
-                    str(ciiu.revision)
-                ])
-            writer.writerow(columns)
+        for index, ruc, data in consulta.query_rucs(read_rucs(input_file), options):
+            if not data:
+                continue
+            writer.writerow(get_row(data))
+            out_file.flush()
+
+
+class RUCBitmap:
+    """
+    Set of valid RUCs in a fixed 50 MB bitmap, whatever the number of RUCs
+    added. The check digit follows from the first 10 digits and there are
+    only 4 prefixes, so every valid RUC has its own bit among 4 * 10^8
+    """
+    PREFIXES = {10: 0, 15: 1, 17: 2, 20: 3}
+    BLOCK = 10 ** 8
+
+    def __init__(self):
+        self.bits = bytearray(len(self.PREFIXES) * self.BLOCK // 8)
+
+    def _position(self, ruc):
+        first_digits = ruc // 10
+        return self.PREFIXES[first_digits // self.BLOCK] * self.BLOCK + first_digits % self.BLOCK
+
+    def __contains__(self, ruc):
+        position = self._position(ruc)
+        return bool(self.bits[position >> 3] & (1 << (position & 7)))
+
+    def add(self, ruc):
+        position = self._position(ruc)
+        self.bits[position >> 3] |= 1 << (position & 7)
+
+
+def read_rucs(input_file):
+    """
+    Yields the valid RUCs of input_file (one per line) the first time each
+    one is seen. Duplicates are detected with a bitmap of fixed size
+    """
+    seen = RUCBitmap()
+    invalid = 0
+    for line in input_file:
+        value = line.strip()
+        if not value:
+            continue
+        try:
+            ruc = int(value)
+        except ValueError:
+            ruc = None
+        if ruc is None or not consulta.Sunat.validate_ruc(ruc):
+            invalid += 1
+            consulta.logger.error("Invalid RUC: %s", value)
+            continue
+        if ruc in seen:
+            continue
+        seen.add(ruc)
+        yield ruc
+
+    if invalid:
+        consulta.logger.info("%d invalid RUCs skipped", invalid)
+
+
+def get_row(ruc):
+    columns = [ruc.nombre, ruc.ruc]
+    for index, ciiu in enumerate(get_main_ciiu(ruc.ciiu)):
+        cod_ciiu = str(ciiu.codigo)
+        cod_ciiu = cod_ciiu + '\\' if cod_ciiu.startswith('0') else cod_ciiu
+
+        columns.extend([
+            cod_ciiu,
+            ciiu.descripcion,
+            str(ciiu.revision)
+        ])
+    return columns
 
 
 def get_main_ciiu(ciiu_list):
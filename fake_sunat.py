@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+"""
+Local fake of the SUNAT RUC search, to measure and test the query engines
+without hitting the real site:
+
+    python fake_sunat.py --port 8000 --latency 0.2 --error-rate 0.05
+    python consulta.py --base-url http://localhost:8000 --engine http --test
+
+It serves the frameset, the search frame, captcha images with a known
+answer per session, result pages (or the error page for a wrong captcha)
+and the getInfoDC/getInfoOT responses. The data of each RUC is generated
+from the RUC, so it is the same on every run
+"""
+from PIL import Image, ImageDraw
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import argparse
+import html
+import io
+import os
+import random
+import string
+import threading
+import time
+import uuid
+
+
+CONSULTA_PATH = '/cl-ti-itmrconsruc/jcrS00Alias'
+BASE_PATH = CONSULTA_PATH.rsplit('/', 1)[0]
+
+ESTADOS = ['ACTIVO', 'ACTIVO', 'ACTIVO', 'BAJA DE OFICIO', 'SUSPENSION TEMPORAL']
+CONDICIONES = ['HABIDO', 'HABIDO', 'HABIDO', 'NO HABIDO', 'NO HALLADO']
+ACTIVIDADES = [
+    (51906, 'OTROS TIPOS DE VENTA AL POR MAYOR.'),
+    (52399, 'VENTA AL POR MENOR EN ALMACENES NO ESPECIALIZADOS.'),
+    (74142, 'ACTIVIDADES DE ASESORAMIENTO EMPRESARIAL.'),
+    (45207, 'CONSTRUCCION DE EDIFICIOS COMPLETOS.'),
+    (60230, 'TRANSPORTE DE CARGA POR CARRETERA.'),
+]
+TRIBUTOS = ['IGV - CUENTA PROPIA', 'RENTA - CUENTA PROPIA', 'ESSALUD']
+
+FRAMESET_PAGE = """<html><head><title>Consulta RUC</title></head>
+<frameset rows="50%,50%">
+<frame name="frameCriterioBusqueda" src="frameCriterioBusqueda.jsp">
+<frame name="frameResultadoBusqueda" src="frameResultadoBusqueda.html">
+</frameset></html>"""
+
+SEARCH_PAGE = """<html><body>
+<form action="jcrS00Alias" method="post" target="frameResultadoBusqueda">
+<input type="hidden" name="accion" value="consPorRuc">
+<input type="radio" name="tQuery" value="on" checked> RUC
+<input type="text" name="search1">
+<input type="radio" name="tQuery" value="on"> DNI
+<input type="text" name="search2">
+<input type="radio" name="tQuery" value="on"> Nombre
+<input type="text" name="search3">
+<img src="captcha?accion=image">
+<input type="text" name="codigo">
+<input type="submit" value="Buscar">
+</form></body></html>"""
+
+EMPTY_PAGE = "<html><body></body></html>"
+
+ERROR_PAGE = """<html><body>
+<p class="error">{message}</p>
+</body></html>"""
+
+RESULT_PAGE = """<html><body>
+<table>
+<tr><td class="bgn">N&uacute;mero de RUC: </td><td class="bg">{ruc} - {nombre}</td></tr>
+<tr><td class="bgn">Nombre Comercial:</td><td class="bg">{nombre_comercial}</td></tr>
+<tr><td class="bgn">Estado del Contribuyente:</td><td class="bg">{estado}</td></tr>
+<tr><td class="bgn">Condici&oacute;n del Contribuyente:</td><td class="bg">{condicion}</td></tr>
+<tr><td class="bgn">Actividad(es) Econ&oacute;mica(s):</td><td class="bg">
+<select name="select">{options}</select>
+<!--<select name="select">{old_options}</select>-->
+</td></tr>
+</table></body></html>"""
+
+EXTENDED_PAGE = """<html><body>
+<table><tr><td class="bgn">{title}</td></tr></table>
+<table><tr><td class="bgn">{intro}</td></tr>
+<tr><td><table><tr><td><table>{rows}</table></td></tr></table></td></tr>
+</table></body></html>"""
+
+
+def fake_data(ruc):
+    """
+    Taxpayer data generated from the RUC
+    """
+    rnd = random.Random(ruc)
+    activities = rnd.sample(ACTIVIDADES, rnd.randint(1, 2))
+    return {
+        'ruc': ruc,
+        'nombre': 'EMPRESA {} S.A.C.'.format(ruc),
+        'nombre_comercial': rnd.choice(['-', 'COMERCIAL {}'.format(ruc % 1000)]),
+        'estado': rnd.choice(ESTADOS),
+        'condicion': rnd.choice(CONDICIONES),
+        'ciiu': activities,
+        'ciiu_rev3': activities[:1],
+        'deuda_coactiva': [
+            ('{:.2f}'.format(rnd.uniform(100, 50000)),
+             '2016-{:02d}'.format(rnd.randint(1, 12)),
+             '{:02d}/{:02d}/2017'.format(rnd.randint(1, 28), rnd.randint(1, 12)),
+             'LIMA')
+            for _ in range(rnd.choice([0, 0, 1, 2]))
+        ],
+        'omision_tributaria': [
+            ('2017-{:02d}'.format(rnd.randint(1, 12)), rnd.choice(TRIBUTOS))
+            for _ in range(rnd.choice([0, 0, 0, 1]))
+        ],
+    }
+
+
+def result_page(data):
+    def options(activities, prefix):
+        return ''.join(
+            '<option value="00">Principal - {}{} - {}</option>'.format(prefix, codigo, html.escape(desc))
+            for codigo, desc in activities
+        )
+    return RESULT_PAGE.format(
+        ruc=data['ruc'],
+        nombre=html.escape(data['nombre']),
+        nombre_comercial=html.escape(data['nombre_comercial']),
+        estado=data['estado'],
+        condicion=data['condicion'],
+        options=options(data['ciiu'], ''),
+        old_options=options(data['ciiu_rev3'], 'CIIU'),
+    )
+
+
+def extended_page(title, rows):
+    if not rows:
+        return EXTENDED_PAGE.format(title=title, intro='No se ha remitido ' + title, rows='')
+    header = '<tr>' + '<td>-</td>' * len(rows[0]) + '</tr>'
+    cells = ''.join(
+        '<tr>' + ''.join('<td>{}</td>'.format(html.escape(value)) for value in row) + '</tr>'
+        for row in rows
+    )
+    return EXTENDED_PAGE.format(title=title, intro='Se tiene ' + title, rows=header + cells)
+
+
+def captcha_image(text):
+    image = Image.new('L', (40, 14), 255)
+    ImageDraw.Draw(image).text((4, 2), text, fill=0)
+    output = io.BytesIO()
+    # The default font is tiny, scaled up so it can be read
+    image.resize((image.width * 3, image.height * 3), Image.NEAREST).save(output, 'PNG')
+    return output.getvalue()
+
+
+class Session:
+    def __init__(self):
+        self.captcha = None
+        self.captcha_uses = 0
+        self.last_result = EMPTY_PAGE
+
+
+class FakeSunat:
+    """
+    State of the fake server: sessions, counters and the simulated
+    latency, errors and throttling
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, max_rate=0.0,
+                 captcha_text=None, captcha_uses=1, save_captchas=None, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_rate = max_rate
+        self.captcha_text = captcha_text
+        self.captcha_uses = captcha_uses
+        self.save_captchas = save_captchas
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.requests = 0
+        self.searches = 0
+        self.rejected = 0
+        self.throttled = 0
+        # Sliding one second window of request times, for throttling
+        self.recent = []
+
+    def new_session(self):
+        session_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[session_id] = Session()
+        return session_id
+
+    def get_session(self, session_id):
+        with self.lock:
+            return self.sessions.get(session_id)
+
+    def delay(self):
+        if self.latency:
+            with self.lock:
+                wait = self.random.uniform(0, 2 * self.latency)
+            time.sleep(wait)
+
+    def is_throttled(self):
+        """
+        True when more than max_rate requests arrived in the last second
+        """
+        if not self.max_rate:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            self.recent = [t for t in self.recent if now - t < 1]
+            self.recent.append(now)
+            throttled = len(self.recent) > self.max_rate
+            if throttled:
+                self.throttled += 1
+            return throttled
+
+    def random_error(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def new_captcha(self, session):
+        with self.lock:
+            text = self.captcha_text or ''.join(self.random.choice(string.ascii_uppercase) for _ in range(4))
+            session.captcha = text
+            session.captcha_uses = 0
+        image = captcha_image(text)
+        if self.save_captchas:
+            name = '{}-{}.png'.format(text, uuid.uuid4().hex[:8])
+            with open(os.path.join(self.save_captchas, name), 'wb') as f:
+                f.write(image)
+        return image
+
+    def check_captcha(self, session, answer):
+        """
+        A captcha is valid for captcha_uses searches (0 for no limit)
+        """
+        with self.lock:
+            self.searches += 1
+            valid = (
+                session is not None and session.captcha is not None and
+                answer.upper() == session.captcha
+            )
+            if valid:
+                session.captcha_uses += 1
+                if self.captcha_uses and session.captcha_uses >= self.captcha_uses:
+                    session.captcha = None
+            else:
+                self.rejected += 1
+            return valid
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'searches': self.searches,
+                'rejected': self.rejected,
+                'throttled': self.throttled,
+            }
+
+
+class FakeSunatHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are sent separately, without this every response
+    # waits for the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_page(self, body, content_type='text/html; charset=ISO-8859-1', status=200):
+        if isinstance(body, str):
+            body = body.encode('latin-1', 'xmlcharrefreplace')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if self.new_session_id is not None:
+            self.send_header('Set-Cookie', 'JSESSIONID={}; Path=/'.format(self.new_session_id))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def session(self, create=False):
+        self.new_session_id = None
+        cookies = self.headers.get('Cookie', '')
+        for cookie in cookies.split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == 'JSESSIONID':
+                session = self.fake.get_session(value)
+                if session is not None:
+                    return session
+        if not create:
+            return None
+        self.new_session_id = self.fake.new_session()
+        return self.fake.get_session(self.new_session_id)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self.handle_request(url.path, parse_qs(url.query))
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode('latin-1'))
+        form.update(parse_qs(url.query))
+        self.handle_request(url.path, form)
+
+    def handle_request(self, path, params):
+        with self.fake.lock:
+            self.fake.requests += 1
+        self.fake.delay()
+        accion = params.get('accion', [''])[0]
+        # Sessions start at the main page or the captcha, as in SUNAT
+        session = self.session(create=path == BASE_PATH + '/captcha' or (
+            path == CONSULTA_PATH and accion == ''))
+
+        if path == CONSULTA_PATH and accion == '':
+            self.send_page(FRAMESET_PAGE)
+        elif path == BASE_PATH + '/frameCriterioBusqueda.jsp':
+            self.send_page(SEARCH_PAGE)
+        elif path == BASE_PATH + '/frameResultadoBusqueda.html':
+            self.send_page(session.last_result if session is not None else EMPTY_PAGE)
+        elif path == BASE_PATH + '/captcha' and accion == 'image':
+            self.send_page(self.fake.new_captcha(session), 'image/png')
+        elif path == CONSULTA_PATH and accion == 'consPorRuc':
+            self.search(session, params)
+        elif path == CONSULTA_PATH and accion in ('getInfoDC', 'getInfoOT'):
+            self.extended(accion, params)
+        else:
+            self.send_page(ERROR_PAGE.format(message='Pagina no encontrada'), status=404)
+
+    def search(self, session, params):
+        ruc = (params.get('search1') or params.get('nroRuc') or [''])[0]
+        answer = params.get('codigo', [''])[0]
+        if self.fake.is_throttled():
+            page = ERROR_PAGE.format(message='Surgieron problemas al procesar la consulta')
+        elif self.fake.random_error():
+            self.send_page(ERROR_PAGE.format(message='Error interno'), status=500)
+            return
+        elif not self.fake.check_captcha(session, answer):
+            page = ERROR_PAGE.format(message='El codigo ingresado es incorrecto')
+        elif not (len(ruc) == 11 and ruc.isdigit()):
+            page = ERROR_PAGE.format(message='El numero de RUC no es valido')
+        else:
+            page = result_page(fake_data(int(ruc)))
+        if session is not None:
+            session.last_result = page
+        self.send_page(page)
+
+    def extended(self, accion, params):
+        if self.fake.is_throttled() or self.fake.random_error():
+            self.send_page(ERROR_PAGE.format(message='Error interno'), status=500)
+            return
+        data = fake_data(int(params.get('nroRuc', ['0'])[0]))
+        if accion == 'getInfoDC':
+            page = extended_page('Deuda Coactiva', data['deuda_coactiva'])
+        else:
+            page = extended_page('Omision Tributaria', data['omision_tributaria'])
+        self.send_page(page)
+
+
+def create_server(fake, host='127.0.0.1', port=0):
+    """
+    port=0 picks a free port, the base URL is then
+    'http://{}:{}'.format(*server.server_address)
+    """
+    server = ThreadingHTTPServer((host, port), FakeSunatHandler)
+    server.daemon_threads = True
+    server.fake = fake
+    return server
+
+
+def start_server(fake, host='127.0.0.1', port=0):
+    """
+    Serves fake from a background thread, stop it with server.shutdown()
+    """
+    server = create_server(fake, host, port)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def argparse_setup(add_help=True):
+    arg_parser = argparse.ArgumentParser(
+        description="Local fake of the SUNAT RUC search",
+        add_help=add_help
+    )
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8000)
+    arg_parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.0,
+        help='Average seconds added to every response. Default: 0'
+    )
+    arg_parser.add_argument(
+        '--error-rate',
+        type=float,
+        default=0.0,
+        help='Fraction of searches and extended info requests answered with an error 500. Default: 0'
+    )
+    arg_parser.add_argument(
+        '--max-rate',
+        type=float,
+        default=0.0,
+        help='Requests per second above which searches get an error page, as when SUNAT '
+             'throttles. Default: no limit'
+    )
+    arg_parser.add_argument(
+        '--captcha-text',
+        help='Use this answer for every captcha instead of random letters'
+    )
+    arg_parser.add_argument(
+        '--captcha-uses',
+        type=int,
+        default=1,
+        help='Searches accepted with the same captcha, 0 for no limit. Default: 1'
+    )
+    arg_parser.add_argument(
+        '--save-captchas',
+        metavar='DIR',
+        help='Save every captcha served as DIR/<answer>-<id>.png, to train captcha.py with'
+    )
+    arg_parser.add_argument('--seed', type=int, help='Seed for the simulated latency and errors')
+    return arg_parser
+
+
+def create_fake(args):
+    return FakeSunat(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        max_rate=args.max_rate,
+        captcha_text=args.captcha_text,
+        captcha_uses=args.captcha_uses,
+        save_captchas=args.save_captchas,
+        seed=args.seed
+    )
+
+
+def main(argv=None):
+    args = argparse_setup().parse_args(argv)
+    if args.save_captchas:
+        os.makedirs(args.save_captchas, exist_ok=True)
+    server = create_server(create_fake(args), args.host, args.port)
+    print("Fake SUNAT at http://{}:{}".format(*server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(server.fake.stats())
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
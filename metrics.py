@@ -0,0 +1,158 @@
+import json
+import math
+import threading
+import time
+
+
+class Histogram:
+    """
+    Counts of observed values in logarithmic buckets, so percentiles are
+    known within 5% using a small fixed amount of memory.
+    Bucket i holds the values up to MIN_VALUE * GROWTH ** i
+    """
+    MIN_VALUE = 0.0001
+    GROWTH = 1.1
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        index = 0
+        if value > self.MIN_VALUE:
+            index = math.ceil(math.log(value / self.MIN_VALUE, self.GROWTH))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * percent / 100)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                break
+        # Geometric middle of the bucket
+        return min(self.MIN_VALUE * self.GROWTH ** max(index - 0.5, 0), self.max)
+
+
+class _Timer:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    """
+    Latency histograms per query stage (page load, OCR, parse...), shared
+    by every worker:
+
+        with metrics.timer('ocr'):
+            ...
+
+    Stages may be nested, e.g. the rate limiter wait ('throttle') is also
+    part of the stage that called it
+    """
+    percentiles = (50, 95, 99)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def timer(self, stage):
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.add(seconds)
+
+    def snapshot(self):
+        """
+        Returns {stage: {count, sum, max, p50, p95, p99}}
+        """
+        with self.lock:
+            stats = {}
+            for stage, histogram in sorted(self.histograms.items()):
+                stage_stats = {
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'max': histogram.max,
+                }
+                for percent in self.percentiles:
+                    stage_stats['p{}'.format(percent)] = histogram.percentile(percent)
+                stats[stage] = stage_stats
+            return stats
+
+    def summary(self):
+        lines = ["{:<24} {:>8} {:>10} {:>10} {:>10}".format('Stage', 'Count', 'p50 (s)', 'p95 (s)', 'p99 (s)')]
+        for stage, stats in self.snapshot().items():
+            lines.append("{:<24} {:>8} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+                stage, stats['count'], stats['p50'], stats['p95'], stats['p99']))
+        return '\n'.join(lines)
+
+    def to_prometheus(self, name='sunat_stage_seconds'):
+        """
+        Prometheus text format, one summary with a stage label
+        """
+        lines = [
+            '# HELP {} Time spent in each stage of a SUNAT query'.format(name),
+            '# TYPE {} summary'.format(name),
+        ]
+        for stage, stats in self.snapshot().items():
+            for percent in self.percentiles:
+                lines.append('{}{{stage="{}",quantile="{}"}} {}'.format(
+                    name, stage, percent / 100, stats['p{}'.format(percent)]))
+            lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage, stats['sum']))
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, stats['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Saves the metrics as JSON if path ends with .json, in Prometheus
+        text format otherwise
+        """
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump(self.snapshot(), f, indent=2)
+            else:
+                f.write(self.to_prometheus())
+
+
+class NullMetrics:
+    """
+    Used when metrics are disabled, timers do nothing
+    """
+    class _NullTimer:
+        __slots__ = ()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+    _timer = _NullTimer()
+
+    def timer(self, stage):
+        return self._timer
+
+    def observe(self, stage, seconds):
+        pass
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Local copy of the padrón reducido published by SUNAT, a pipe delimited
+file (latin-1) with one taxpayer per line:
+
+    RUC|NOMBRE O RAZÓN SOCIAL|ESTADO DEL CONTRIBUYENTE|CONDICIÓN DE DOMICILIO|UBIGEO|...
+
+The file (or the zip it is distributed in) is read line by line into an
+SQLite database keyed by RUC:
+
+    python padron.py padron_reducido_ruc.zip padron.sqlite3
+"""
+import argparse
+import io
+import itertools
+import os
+import sqlite3
+import threading
+import time
+import zipfile
+
+
+class Padron:
+    """
+    RUC lookups in a database created by import_padron. Estado and
+    condicion are stored as codes of a small table, they only take a
+    handful of values
+    """
+    def __init__(self, path):
+        if not os.path.isfile(path):
+            raise ValueError("Padrón database not found: {}".format(path))
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.values = dict(self.conn.execute('SELECT code, value FROM padron_values'))
+
+    def get(self, ruc):
+        """
+        Returns a dict with ruc, nombre, estado, condicion and ubigeo, or
+        None if the RUC is not in the padrón
+        """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT nombre, estado, condicion, ubigeo FROM padron WHERE ruc = ?',
+                (int(ruc),)
+            ).fetchone()
+        if row is None:
+            return None
+        nombre, estado, condicion, ubigeo = row
+        return {
+            'ruc': int(ruc),
+            'nombre': nombre,
+            'estado': self.values[estado],
+            'condicion': self.values[condicion],
+            'ubigeo': ubigeo,
+        }
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM padron').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def open_text(path, encoding='latin-1'):
+    """
+    Opens the padrón as text, reading the first file inside if it's a zip
+    """
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        return io.TextIOWrapper(archive.open(archive.namelist()[0]), encoding=encoding, newline='')
+    return open(path, encoding=encoding, newline='')
+
+
+def parse_lines(lines, codes, skipped):
+    """
+    Yields (ruc, nombre, estado, condicion, ubigeo) rows. Lines without a
+    valid RUC (the header included) are counted in skipped[0]
+    """
+    for line in lines:
+        fields = line.rstrip('\r\n').split('|')
+        if len(fields) < 5 or len(fields[0]) != 11 or not fields[0].isdigit():
+            skipped[0] += 1
+            continue
+        estado = fields[2].strip()
+        condicion = fields[3].strip()
+        if estado not in codes:
+            codes[estado] = len(codes)
+        if condicion not in codes:
+            codes[condicion] = len(codes)
+        yield int(fields[0]), fields[1].strip(), codes[estado], codes[condicion], fields[4].strip()
+
+
+def import_padron(infile, path, batch_size=100000, encoding='latin-1'):
+    """
+    Replaces the database at path with the contents of infile, reading
+    batch_size lines at a time. Returns (rows imported, lines skipped)
+    """
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    # The database is built from scratch, there's nothing to recover if
+    # the import is interrupted
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute(
+        'CREATE TABLE padron ('
+        'ruc INTEGER PRIMARY KEY, nombre TEXT, '
+        'estado INTEGER, condicion INTEGER, ubigeo TEXT)'
+    )
+    conn.execute('CREATE TABLE padron_values (code INTEGER PRIMARY KEY, value TEXT)')
+
+    codes = {}
+    skipped = [0]
+    imported = 0
+    with open_text(infile, encoding) as f:
+        rows = parse_lines(f, codes, skipped)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            # The same RUC may appear more than once, the last one wins
+            conn.executemany('INSERT OR REPLACE INTO padron VALUES (?, ?, ?, ?, ?)', batch)
+            imported += len(batch)
+    conn.executemany(
+        'INSERT INTO padron_values VALUES (?, ?)',
+        [(code, value) for value, code in codes.items()]
+    )
+    conn.commit()
+    conn.close()
+    os.replace(tmp_path, path)
+    return imported, skipped[0]
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        description="Import the padrón reducido of SUNAT into a local database"
+    )
+    arg_parser.add_argument('infile', help='padron_reducido_ruc.txt or the zip that contains it')
+    arg_parser.add_argument('database', help='SQLite database to create')
+    arg_parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=100000,
+        help='Rows inserted at once. Default: 100000'
+    )
+    args = arg_parser.parse_args(argv)
+
+    start = time.perf_counter()
+    imported, skipped = import_padron(args.infile, args.database, args.batch_size)
+    print("{} rows imported to {} in {:.1f} s, {} lines skipped".format(
+        imported, args.database, time.perf_counter() - start, skipped))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import contextlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ResourcePool:
+    """
+    Pool of expensive resources (web drivers, HTTP sessions) reused between
+    queries. A resource is recycled after max_uses queries or when
+    health_check(resource) returns False before handing it out again
+    """
+    def __init__(self, factory, close, size, logger, max_uses=100,
+                 health_check=None):
+        self.factory = factory
+        self.close_resource = close
+        self.size = size
+        self.logger = logger
+        self.max_uses = max_uses
+        self.health_check = health_check
+        self.lock = threading.Lock()
+        self.uses = {}
+        # The most recently used resource is handed out first.
+        # None marks a free slot whose resource is created on demand
+        self.idle = queue.LifoQueue()
+        for _ in range(size):
+            self.idle.put(None)
+
+    def prewarm(self):
+        """
+        Creates every resource of the pool concurrently
+        """
+        slots = [self.idle.get() for _ in range(self.size)]
+        empty = [slot for slot in slots if slot is None]
+        with ThreadPoolExecutor(max_workers=max(len(empty), 1)) as executor:
+            created = list(executor.map(lambda _: self.create(), empty))
+        for resource in [slot for slot in slots if slot is not None] + created:
+            self.idle.put(resource)
+
+    def create(self):
+        resource = self.factory()
+        with self.lock:
+            self.uses[resource] = 0
+        return resource
+
+    def discard(self, resource):
+        with self.lock:
+            self.uses.pop(resource, None)
+        try:
+            self.close_resource(resource)
+        except Exception as e:
+            self.logger.error("Couldn't close pooled resource: %s", e)
+
+    def is_healthy(self, resource):
+        if self.health_check is None:
+            return True
+        try:
+            return self.health_check(resource)
+        except Exception:
+            return False
+
+    def acquire(self):
+        resource = self.idle.get()
+        if resource is not None and not self.is_healthy(resource):
+            self.logger.info("Recycling unhealthy resource")
+            self.discard(resource)
+            resource = None
+
+        if resource is None:
+            try:
+                resource = self.create()
+            except Exception:
+                self.idle.put(None)
+                raise
+        return resource
+
+    def release(self, resource):
+        with self.lock:
+            self.uses[resource] += 1
+            worn_out = self.uses[resource] >= self.max_uses
+
+        if worn_out:
+            self.logger.info("Recycling resource after %d uses", self.max_uses)
+            self.discard(resource)
+            resource = None
+        self.idle.put(resource)
+
+    @contextlib.contextmanager
+    def resource(self):
+        resource = self.acquire()
+        try:
+            yield resource
+        finally:
+            self.release(resource)
+
+    def close(self):
+        with self.lock:
+            resources = list(self.uses)
+        for resource in resources:
+            self.discard(resource)
@@ -0,0 +1,64 @@
+import asyncio
+import multiprocessing
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the requests per second sent to SUNAT.
+    The state lives in shared memory, so one limiter is shared by every
+    thread and by processes forked after its creation.
+    The rate adapts with AIMD: it grows by `increase` after each successful
+    query and is multiplied by `decrease` after a timeout or overload error
+    """
+    def __init__(self, rate, min_rate=0.1, max_rate=None, burst=1,
+                 increase=0.05, decrease=0.5):
+        self.min_rate = min_rate
+        self.max_rate = max_rate if max_rate is not None else rate * 4
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.lock = multiprocessing.Lock()
+        self._rate = multiprocessing.Value('d', rate, lock=False)
+        self._tokens = multiprocessing.Value('d', burst, lock=False)
+        self._updated = multiprocessing.Value('d', time.monotonic(), lock=False)
+
+    @property
+    def rate(self):
+        return self._rate.value
+
+    def try_acquire(self):
+        """
+        Takes a token if there is one. Returns 0 on success or the seconds
+        to wait before trying again
+        """
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self._updated.value
+            self._updated.value = now
+            tokens = min(self.burst, self._tokens.value + elapsed * self._rate.value)
+            if tokens >= 1:
+                self._tokens.value = tokens - 1
+                return 0
+            self._tokens.value = tokens
+            return (1 - tokens) / self._rate.value
+
+    def acquire(self):
+        wait = self.try_acquire()
+        while wait:
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+    async def aacquire(self):
+        wait = self.try_acquire()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self.try_acquire()
+
+    def on_success(self):
+        with self.lock:
+            self._rate.value = min(self.max_rate, self._rate.value + self.increase)
+
+    def on_error(self):
+        with self.lock:
+            self._rate.value = max(self.min_rate, self._rate.value * self.decrease)
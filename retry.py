@@ -0,0 +1,204 @@
+import collections
+import heapq
+import itertools
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from selenium.common.exceptions import TimeoutException
+import requests
+from .sunat import (
+    InvalidRUCError,
+    CaptchaError,
+    SunatErrorPage,
+    SunatOverloadedPage,
+    ResultParseError
+)
+
+
+class RetryPolicy:
+    """
+    How to retry a query after a kind of failure.
+    retry is one of NEVER, NOW (before any other pending query) or LATER
+    (after an exponential backoff with jitter, behind the rest of the batch)
+    """
+    NEVER = 'never'
+    NOW = 'now'
+    LATER = 'later'
+
+    def __init__(self, name, retry, base_delay=0, max_delay=0):
+        self.name = name
+        self.retry = retry
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        """
+        Full jitter: a random wait between 0 and the exponential backoff
+        """
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, backoff)
+
+
+def default_policies(base_delay=1, max_delay=60):
+    """
+    Failure classes checked in order, the first match applies
+    """
+    return [
+        (InvalidRUCError, RetryPolicy('invalid RUC', RetryPolicy.NEVER)),
+        # Reading another captcha is cheap, there's no reason to wait
+        (CaptchaError, RetryPolicy('captcha misread', RetryPolicy.NOW)),
+        # The overload page is also an error page, but SUNAT needs time
+        (SunatOverloadedPage, RetryPolicy('SUNAT overloaded', RetryPolicy.LATER, base_delay, max_delay)),
+        (SunatErrorPage, RetryPolicy('captcha rejected', RetryPolicy.NOW)),
+        ((TimeoutException, requests.exceptions.Timeout, requests.exceptions.ConnectionError),
+         RetryPolicy('timeout', RetryPolicy.LATER, base_delay, max_delay)),
+        (ResultParseError, RetryPolicy('parse error', RetryPolicy.LATER, base_delay, max_delay)),
+        (Exception, RetryPolicy('other error', RetryPolicy.LATER, base_delay, max_delay)),
+    ]
+
+
+class Task:
+    def __init__(self, index, ruc):
+        self.index = index
+        self.ruc = ruc
+        self.attempts = 0
+
+
+class RetryScheduler:
+    """
+    Runs query(ruc) for many RUCs on a pool of worker threads, retrying
+    failures according to their policy. LATER retries go to the end of
+    the batch: they only run when no RUC of rucs is left to start.
+    max_retries limits the attempts per RUC and budget the retries of the
+    whole batch, -1 means no limit
+    """
+    def __init__(self, query, logger, workers=1, max_retries=-1, budget=-1,
+                 policies=None):
+        self.query = query
+        self.logger = logger
+        self.workers = workers
+        self.max_retries = max_retries
+        self.budget = budget
+        self.policies = policies if policies is not None else default_policies()
+        self.retries = 0
+        self.failures = collections.Counter()
+
+    def classify(self, error):
+        for error_class, policy in self.policies:
+            if isinstance(error, error_class):
+                return policy
+        return RetryPolicy('other error', RetryPolicy.NEVER)
+
+    def use_retry(self):
+        """
+        Takes one retry from the budget of the batch, False if there are
+        none left. Also used by the async extended phase
+        """
+        if self.budget != -1 and self.retries >= self.budget:
+            return False
+        self.retries += 1
+        return True
+
+    def run(self, rucs):
+        """
+        Yields (index, ruc, data) tuples in completion order, data is None
+        when the query failed. rucs is consumed lazily
+        """
+        source = enumerate(rucs)
+        total = len(rucs) if hasattr(rucs, '__len__') else None
+        exhausted = False
+        # NOW retries, run before anything else
+        ready = collections.deque()
+        # (not_before, sequence, task) heap of tasks waiting for their backoff
+        delayed = []
+        # LATER retries whose backoff expired, run once rucs is exhausted
+        tail = collections.deque()
+        sequence = itertools.count()
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                now = time.monotonic()
+                while delayed and delayed[0][0] <= now:
+                    tail.append(heapq.heappop(delayed)[2])
+
+                while len(running) < self.workers:
+                    if ready:
+                        task = ready.popleft()
+                    elif not exhausted:
+                        try:
+                            task = Task(*next(source))
+                        except StopIteration:
+                            exhausted = True
+                            continue
+                    elif tail:
+                        task = tail.popleft()
+                    else:
+                        break
+                    task.attempts += 1
+                    if task.attempts == 1:
+                        self.log_start(task, total)
+                    running[executor.submit(self.query, task.ruc)] = task
+
+                if not running:
+                    if not delayed:
+                        break
+                    time.sleep(max(delayed[0][0] - now, 0))
+                    continue
+
+                timeout = max(delayed[0][0] - now, 0) if delayed else None
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    error = future.exception()
+                    data = None if error else future.result()
+                    if data:
+                        self.logger.info("Request for RUC %d completed successfully", task.ruc)
+                        yield task.index, task.ruc, data
+                        continue
+
+                    policy = self.reschedule(task, error, ready, delayed, sequence)
+                    if policy is not None:
+                        yield task.index, task.ruc, None
+
+        if self.failures:
+            self.logger.info(
+                "%d retries used. Failures: %s",
+                self.retries,
+                ', '.join('{}: {}'.format(k, v) for k, v in self.failures.most_common())
+            )
+
+    def log_start(self, task, total):
+        if total is None:
+            self.logger.info("Started request for RUC: %d (%d)", task.ruc, task.index + 1)
+        else:
+            self.logger.info("Started request for RUC: %d (%d/%d)", task.ruc, task.index + 1, total)
+
+    def reschedule(self, task, error, ready, delayed, sequence):
+        """
+        Queues task again according to the policy for error.
+        Returns the policy if the RUC is given up, None otherwise
+        """
+        if error is None:
+            # Sunat already logged and swallowed the error
+            error = Exception("Empty result")
+        policy = self.classify(error)
+        self.failures[policy.name] += 1
+
+        if policy.retry == RetryPolicy.NEVER:
+            self.logger.error("Request for RUC: %d failed (%s)", task.ruc, policy.name)
+            return policy
+        if self.max_retries != -1 and task.attempts >= self.max_retries:
+            self.logger.error("Max number of retries reached. Request for RUC: %d failed", task.ruc)
+            return policy
+        if not self.use_retry():
+            self.logger.error("Retry budget exhausted. Request for RUC: %d failed", task.ruc)
+            return policy
+
+        if policy.retry == RetryPolicy.NOW:
+            ready.appendleft(task)
+        else:
+            delay = policy.delay(task.attempts)
+            self.logger.info("Retrying RUC %d in %.1f seconds (%s)", task.ruc, delay, policy.name)
+            heapq.heappush(delayed, (time.monotonic() + delay, next(sequence), task))
+        return None
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from .utils import dumps
+
+
+def field_hash(value):
+    # The stdlib encoder gives the same text on every installation
+    text = dumps(value, backend='json')
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def record_hash(hashes):
+    return field_hash(sorted(hashes.items()))
+
+
+class Snapshot:
+    """
+    Last known state of every RUC queried, to report what changed since
+    the previous run. Each field is stored as JSON with its hash, and the
+    record hash (of the field hashes) tells with a single comparison
+    whether anything changed. Unchanged records are not written again,
+    only their count of checks.
+    The checks and changes of each RUC are counted so the ones that change
+    often can be queried first
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS snapshot ('
+                'ruc INTEGER PRIMARY KEY, hash TEXT, hashes TEXT, data TEXT, '
+                'checks INTEGER, changes INTEGER, checked REAL, changed REAL)'
+            )
+
+    def _get(self, ruc):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT hash, hashes, data FROM snapshot WHERE ruc = ?',
+                (int(ruc),)
+            ).fetchone()
+
+    def _merge(self, row, data):
+        """
+        Returns (hash, field hashes, JSON values) of the stored record
+        updated with data. Fields not in data keep their stored values
+        """
+        hashes = {}
+        values = {}
+        if row is not None:
+            hashes = json.loads(row[1])
+            values = json.loads(row[2])
+        for field, value in data.items():
+            hashes[field] = field_hash(value)
+            values[field] = value
+        return record_hash(hashes), hashes, values
+
+    @staticmethod
+    def _changed_fields(stored_hashes, data):
+        # A field stored for the first time (e.g. requested for the first
+        # time with --fields) is not a change
+        return [
+            field for field in sorted(data)
+            if field in stored_hashes and stored_hashes[field] != field_hash(data[field])
+        ]
+
+    def diff(self, ruc, data):
+        """
+        Compares data with the stored record. Returns (changed fields,
+        previous values of those fields); previous is None if the RUC was
+        never seen, and then every field is reported as changed
+        """
+        row = self._get(ruc)
+        if row is None:
+            return sorted(data), None
+        changed = self._changed_fields(json.loads(row[1]), data)
+        if not changed:
+            return [], {}
+        stored = json.loads(row[2])
+        return changed, {field: stored[field] for field in changed}
+
+    def update(self, ruc, data):
+        """
+        Stores data as the last known state of ruc and counts the check.
+        The record is only rewritten if its hash changed
+        """
+        row = self._get(ruc)
+        digest, hashes, values = self._merge(row, data)
+        now = time.time()
+        with self.lock, self.conn:
+            if row is None:
+                self.conn.execute(
+                    'INSERT INTO snapshot VALUES (?, ?, ?, ?, 0, 0, ?, NULL)',
+                    (int(ruc), digest, json.dumps(hashes), dumps(values, backend='json'), now)
+                )
+            elif digest == row[0]:
+                self.conn.execute(
+                    'UPDATE snapshot SET checks = checks + 1, checked = ? WHERE ruc = ?',
+                    (now, int(ruc))
+                )
+            else:
+                changed = bool(self._changed_fields(json.loads(row[1]), data))
+                self.conn.execute(
+                    'UPDATE snapshot SET hash = ?, hashes = ?, data = ?, '
+                    'checks = checks + 1, changes = changes + ?, checked = ?, '
+                    'changed = CASE WHEN ? THEN ? ELSE changed END '
+                    'WHERE ruc = ?',
+                    (digest, json.dumps(hashes), dumps(values, backend='json'),
+                     int(changed), now, changed, now, int(ruc))
+                )
+
+    def prioritize(self, rucs):
+        """
+        Returns rucs in the order they should be queried: the ones never
+        seen first, then by how often they changed in previous runs. The
+        change rate is (changes + 1) / (checks + 2) so a RUC checked a
+        few times isn't ranked first or last by chance
+        """
+        with self.lock:
+            stats = {
+                ruc: (changes + 1) / (checks + 2)
+                for ruc, checks, changes in self.conn.execute(
+                    'SELECT ruc, checks, changes FROM snapshot'
+                )
+            }
+        return sorted(rucs, key=lambda ruc: -stats.get(int(ruc), 1.0))
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM snapshot').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
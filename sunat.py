@@ -1,11 +1,16 @@
 from selenium.common.exceptions import *
 from PIL import Image
-import pyocr
 import requests
+import aiohttp
+import asyncio
 import bs4
+import lxml.html
 import re
-import collections
-import tempfile
+import html
+import collections.abc
+import io
+from .captcha import CaptchaSolver
+from .metrics import NullMetrics
 from .utils import (
     CIIU,
     DeudaCoactiva,
@@ -14,15 +19,184 @@ from .utils import (
 )
 
 
+BASE_URL = 'http://e-consultaruc.sunat.gob.pe'
+CONSULTA_PATH = '/cl-ti-itmrconsruc/jcrS00Alias'
+
+# Fields of a query result. The basic ones come from the result page,
+# each extended one from its own request
+BASIC_FIELDS = ('ruc', 'nombre', 'nombre_comercial', 'estado', 'condicion', 'ciiu')
+EXTENDED_FIELDS = ('deuda_coactiva', 'omision_tributaria')
+ALL_FIELDS = BASIC_FIELDS + EXTENDED_FIELDS
+# Fields found in the padrón reducido
+PADRON_FIELDS = ('ruc', 'nombre', 'estado', 'condicion')
+
+# Text of an option inside a commented out select. The closing tag may be
+# in another comment
+COMMENT_OPTION_RE = re.compile(r'<option[^>]*>(.*?)(?=</option>|<option|$)', re.IGNORECASE | re.DOTALL)
+TAG_RE = re.compile(r'<[^>]*>')
+
+# Labels of the fields in the result page
+RESULT_LABELS = [
+    ('ruc', re.compile(r'n[ú|u]mero\s+de\s+ruc:\s+', re.IGNORECASE)),
+    ('nombre_comercial', re.compile(r'nombre\s+comercial:\s*', re.IGNORECASE)),
+    ('estado', re.compile(r'estado\s+del?\s+contribuyente:\s*', re.IGNORECASE)),
+    ('condicion', re.compile(r'condici[ó|o]n\s+del\s+contribuyente:\s*', re.IGNORECASE)),
+]
+
+
 class InvalidRUCError(Exception):
     pass
 
 
+def check_fields(fields):
+    """
+    Raises ValueError if any of fields is not in ALL_FIELDS
+    """
+    unknown = [field for field in fields if field not in ALL_FIELDS]
+    if unknown:
+        raise ValueError("Unknown fields: {}. Valid fields: {}".format(
+            ', '.join(unknown), ', '.join(ALL_FIELDS)))
+
+
+class SunatErrorPage(AttributeError):
+    """
+    SUNAT answered with an error page, usually because of a wrong captcha
+    """
+    pass
+
+
+# Errors that may mean SUNAT is overloaded or throttling us. A rejected
+# captcha is also an error page, it says nothing about the load
+THROTTLING_ERRORS = (
+    TimeoutException,
+    requests.exceptions.Timeout,
+    requests.exceptions.ConnectionError,
+    asyncio.TimeoutError,
+    aiohttp.ClientConnectionError
+)
+# Error page messages shown when SUNAT is overloaded
+THROTTLING_MESSAGES = (
+    'surgieron problemas al procesar la consulta',
+)
+# HTTP statuses of an overloaded or throttling server
+THROTTLING_STATUSES = (429, 500, 502, 503, 504)
+
+
+class SunatOverloadedPage(SunatErrorPage):
+    """
+    Error page shown when SUNAT is overloaded, the captcha wasn't checked
+    """
+    pass
+
+
+def error_page(message):
+    """
+    Returns the exception for an error page showing message
+    """
+    lower = message.lower()
+    if any(text in lower for text in THROTTLING_MESSAGES):
+        return SunatOverloadedPage(message)
+    return SunatErrorPage(message)
+
+
+def is_throttling_error(error):
+    if isinstance(error, THROTTLING_ERRORS):
+        return True
+    if isinstance(error, SunatErrorPage):
+        message = str(error).lower()
+        return any(text in message for text in THROTTLING_MESSAGES)
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code in THROTTLING_STATUSES
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in THROTTLING_STATUSES
+    return False
+
+
+class CaptchaError(ValueError):
+    """
+    The captcha couldn't be read
+    """
+    pass
+
+
+class ResultParseError(ValueError):
+    """
+    The result page doesn't have the expected structure
+    """
+    pass
+
+
 class Sunat:
-    def __init__(self, web_driver, logger):
+    def __init__(self, web_driver, logger, session=None, cache=None,
+                 captcha_solver=None, parser='bs4', raise_errors=False,
+                 rate_limiter=None, metrics=None, base_url=None,
+                 reuse_captcha=False, padron=None):
+        if parser not in ('bs4', 'lxml'):
+            raise ValueError("parser must be one of: bs4, lxml")
         self.web_driver = web_driver
         self.logger = logger
-        self.url_consulta = 'http://e-consultaruc.sunat.gob.pe/cl-ti-itmrconsruc/jcrS00Alias'
+        self.cache = cache
+        self.parser = parser
+        # Propagate query errors instead of returning None, so the caller
+        # can decide how to retry
+        self.raise_errors = raise_errors
+        # Shared by every instance querying SUNAT at the same time
+        self.rate_limiter = rate_limiter
+        if captcha_solver is None:
+            captcha_solver = CaptchaSolver(logger)
+        self.captcha_solver = captcha_solver
+        # Shared by every plain HTTP request so connections are kept alive
+        self.session = session if session is not None else requests.Session()
+        # base_url points the queries to another server, e.g. fake_sunat.py
+        self.url_consulta = (base_url or BASE_URL).rstrip('/') + CONSULTA_PATH
+        # Consecutive page load timeouts
+        self.timeouts = 0
+        # padron.Padron answering queries that only need PADRON_FIELDS
+        self.padron = padron
+        # Keep searching with the last accepted captcha until SUNAT rejects it
+        self.reuse_captcha = reuse_captcha
+        self.captcha = None
+        # Time spent in each stage of a query, shared by every instance
+        self.metrics = metrics if metrics is not None else NullMetrics()
+
+    def throttle(self):
+        """
+        Waits until the rate limiter allows another request
+        """
+        if self.rate_limiter is not None:
+            with self.metrics.timer('throttle'):
+                self.rate_limiter.acquire()
+
+    def report_rate(self, error=None):
+        """
+        Lowers the request rate after a timeout, connection error or
+        overload page (not after a rejected captcha), raises it after a
+        successful query
+        """
+        if self.rate_limiter is None:
+            return
+        if error is None:
+            self.rate_limiter.on_success()
+        elif is_throttling_error(error):
+            self.rate_limiter.on_error()
+
+    def is_healthy(self, max_timeouts=3):
+        """
+        False when the web driver stopped responding or keeps timing out
+        """
+        if self.timeouts >= max_timeouts:
+            return False
+        if self.web_driver is not None:
+            try:
+                self.web_driver.current_url
+            except Exception:
+                return False
+        return True
+
+    def close(self):
+        if self.web_driver is not None:
+            self.web_driver.quit()
+        self.session.close()
 
     def get_subimage(self, source, loc, size):
         img = Image.open(source)
@@ -37,25 +211,22 @@ class Sunat:
         return img
 
     def get_text_from_image(self, image):
-        tools = pyocr.get_available_tools()
-        if len(tools) == 0:
-            raise ValueError("No OCR tool found")
-
-        tool = tools[0]
-
-        return tool.image_to_string(image)
+        with self.metrics.timer('ocr'):
+            return self.captcha_solver.solve(image)
 
     def get_captcha_image(self, frame_elem):
         img_xpath = '//img[@src="captcha?accion=image"]'
-        self.web_driver.switch_to.frame(frame_elem)
+        with self.metrics.timer('frame_switch'):
+            self.web_driver.switch_to.frame(frame_elem)
 
-        img_file = tempfile.NamedTemporaryFile()
-        self.web_driver.save_screenshot(img_file.name)
-        img_elem = self.web_driver.find_element_by_xpath(img_xpath)
+        with self.metrics.timer('screenshot'):
+            # The screenshot is kept in memory, no need to write it to disk
+            screenshot = io.BytesIO(self.web_driver.get_screenshot_as_png())
+            img_elem = self.web_driver.find_element_by_xpath(img_xpath)
 
-        loc = img_elem.location
-        size = img_elem.size
-        captcha = self.get_subimage(img_file, loc, size)
+            loc = img_elem.location
+            size = img_elem.size
+            captcha = self.get_subimage(screenshot, loc, size)
         self.web_driver.switch_to_default_content()
 
         return captcha
@@ -64,26 +235,62 @@ class Sunat:
         captcha = self.get_captcha_image(frame_elem)
         return self.get_text_from_image(captcha)
 
-    def save_results(self, fileobj):
+    def get_results_source(self):
         frame_path = '//frame[@src="frameResultadoBusqueda.html"]'
-        result_frame = self.web_driver.find_element_by_xpath(frame_path)
-        self.web_driver.switch_to.frame(result_frame)
-        source = self.web_driver.page_source
-        fileobj.write(source)
-        fileobj.seek(0)
-        self.web_driver.switch_to_default_content()
+        with self.metrics.timer('result_frame'):
+            result_frame = self.web_driver.find_element_by_xpath(frame_path)
+            self.web_driver.switch_to.frame(result_frame)
+            source = self.web_driver.page_source
+            self.web_driver.switch_to_default_content()
+        return source
+
+    def get_label_index(self, cells, get_text, get_value):
+        """
+        Maps every field in RESULT_LABELS to the text of the cell next to
+        its label, going through the label cells only once.
+        get_text(cell) returns the text of a label cell and get_value(cell)
+        the text of the cell that follows it
+        """
+        index = {}
+        pending = list(RESULT_LABELS)
+        for cell in cells:
+            text = get_text(cell)
+            for label in pending:
+                field, pattern = label
+                if pattern.search(text):
+                    index[field] = get_value(cell).strip()
+                    pending.remove(label)
+                    break
+            if not pending:
+                break
+        return index
+
+    def get_label_index_bs4(self, soup):
+        return self.get_label_index(
+            soup.find_all('td', {'class': 'bgn'}),
+            lambda cell: cell.get_text(),
+            lambda cell: cell.find_next('td').get_text()
+        )
+
+    def get_label_index_lxml(self, tree):
+        return self.get_label_index(
+            tree.xpath('//td[@class="bgn"]'),
+            lambda cell: cell.text_content(),
+            lambda cell: cell.xpath('following::td[1]')[0].text_content()
+        )
+
+    def get_indexed_field(self, index, field):
+        try:
+            return index[field]
+        except KeyError:
+            raise ValueError("Couldn't find '{field}' in result page".format(field=field))
 
-    def get_ruc_nombre_contribuyente(self, soup):
+    def get_ruc_nombre_contribuyente(self, index):
         """
         Gets the RUC and name (not commercial) of the taxpayer
         Any exception should propagate upwards
         """
-        tag = soup.find(
-            'td',
-            {'class': 'bgn'},
-            text=re.compile('n[ú|u]mero\s+de\s+ruc:\s+', re.IGNORECASE))
-        ruc_tag = tag.find_next('td')
-        text = ruc_tag.get_text()
+        text = self.get_indexed_field(index, 'ruc')
 
         tokens = text.split('-')
         try:
@@ -99,41 +306,25 @@ class Sunat:
 
         return ruc, text.strip()
 
-    def get_nombre_comercial_contribuyente(self, soup):
-        tag = soup.find(
-            'td',
-            {'class': 'bgn'},
-            text=re.compile('nombre\s+comercial:\s*', re.IGNORECASE)
-        )
-        nombre_tag = tag.find_next('td')
-        return nombre_tag.get_text().strip()
-
-    def get_estado_contribuyente(self, soup):
-        tag = soup.find(
-            'td',
-            {'class': 'bgn'},
-            text=re.compile('estado\s+del?\s+contribuyente:\s*', re.IGNORECASE)
-        )
-        estado_tag = tag.find_next('td')
-        return estado_tag.get_text().strip()
-
-    def get_condicion_contribuyente(self, soup):
-        tag = soup.find(
-            'td',
-            {'class': 'bgn'},
-            text=re.compile(
-                'condici[ó|o]n\s+del\s+contribuyente:\s*',
-                re.IGNORECASE
-            )
-        )
-        cond_tag = tag.find_next('td')
-        return cond_tag.get_text().strip()
+    def get_nombre_comercial_contribuyente(self, index):
+        return self.get_indexed_field(index, 'nombre_comercial')
+
+    def get_estado_contribuyente(self, index):
+        return self.get_indexed_field(index, 'estado')
+
+    def get_condicion_contribuyente(self, index):
+        return self.get_indexed_field(index, 'condicion')
 
     def get_ciiu_in_comments(self, soup):
         comments = soup.find_all(
             string=lambda text: isinstance(text, bs4.Comment)
         )
+        return self.get_ciiu_from_comments(comments)
 
+    def get_ciiu_from_comments(self, comments):
+        """
+        Older CIIU (revision 3) are listed in a commented out select
+        """
         ciiu = []
         indexSelect = -1
         selectEnd = False
@@ -142,11 +333,16 @@ class Sunat:
                 indexSelect = index
 
             if indexSelect != -1 and not selectEnd:
-                if '<option' in com:
-                    com_soup = bs4.BeautifulSoup(com, 'lxml')
-                    ciiu.append(com_soup.get_text().strip())
-                elif '</select>' in com:
+                if index == indexSelect:
+                    com = com[com.index('<select name="select"'):]
+                # The select may open and close in the same comment
+                end = com.find('</select>')
+                if end != -1:
+                    com = com[:end]
                     selectEnd = True
+                for option in COMMENT_OPTION_RE.findall(com):
+                    text = html.unescape(TAG_RE.sub('', option))
+                    ciiu.append(text.strip())
 
         ciiu = [CIIU.from_string(ci) for ci in ciiu]
 
@@ -155,8 +351,9 @@ class Sunat:
     def get_clean_ciiu_list(self, ciiu_comments, ciiu_options):
         clean_ciiu = []
 
-        for index, ci in enumerate(ciiu_options):
-            if ci not in ciiu_comments:
+        comment_codes = set(ci.codigo for ci in ciiu_comments)
+        for ci in ciiu_options:
+            if ci.codigo not in comment_codes:
                 ci.revision = 4
                 clean_ciiu.append(ci)
         clean_ciiu += ciiu_comments
@@ -173,21 +370,50 @@ class Sunat:
         ciiu = self.get_clean_ciiu_list(comments, options)
         return ciiu
 
-    def get_extended_info_attr(self, params, accion, func_from_row):
-        if not isinstance(params, collections.Mapping):
+    def check_extended_info_args(self, params, accion, func_from_row):
+        if not isinstance(params, collections.abc.Mapping):
             raise TypeError("params is not dictionary")
         if type(accion) is not str:
             raise TypeError("accion is not string")
         if not callable(func_from_row):
             raise TypeError("func_from_row is not callable")
 
+    def get_extended_info_attr(self, params, accion, func_from_row):
+        self.check_extended_info_args(params, accion, func_from_row)
+
+        params = dict(params, accion=accion)
+        with self.metrics.timer('extended_' + accion):
+            try:
+                self.throttle()
+                res = self.session.get(self.url_consulta, params=params, timeout=5)
+            except requests.exceptions.Timeout as e:
+                e.message = "Couldn't connect to {action} within {time} seconds".format(action=accion, time=5)
+                raise
+            # An overloaded SUNAT answers 429/5xx, don't parse its error page
+            res.raise_for_status()
+            return self.parse_extended_info(res.text, func_from_row)
+
+    async def aget_extended_info_attr(self, session, params, accion, func_from_row):
+        self.check_extended_info_args(params, accion, func_from_row)
+
+        # aiohttp only accepts string values in the query string
+        params = {key: str(value) for key, value in params.items()}
         params['accion'] = accion
-        try:
-            res = requests.get(self.url_consulta, params, timeout=5)
-        except requests.exceptions.Timeout as e:
-            e.message = "Couldn't connect to {action} within {time} seconds".format(action=accion, time=5)
-            raise
-        soup = bs4.BeautifulSoup(res.text, 'lxml')
+        timeout = aiohttp.ClientTimeout(total=5)
+        with self.metrics.timer('extended_' + accion):
+            try:
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.aacquire()
+                async with session.get(self.url_consulta, params=params, timeout=timeout) as res:
+                    res.raise_for_status()
+                    text = await res.text()
+            except asyncio.TimeoutError as e:
+                e.message = "Couldn't connect to {action} within {time} seconds".format(action=accion, time=5)
+                raise
+            return self.parse_extended_info(text, func_from_row)
+
+    def parse_extended_info(self, text, func_from_row):
+        soup = bs4.BeautifulSoup(text, 'lxml')
 
         # First table for the title, second for the results of the query
         tables = soup.find_all('table')
@@ -285,37 +511,133 @@ class Sunat:
         )
         return ot
 
-    def get_extended_information(self, ruc, nombre):
+    def get_extended_information(self, ruc, nombre, fields=EXTENDED_FIELDS):
         """
-        Get extended data
+        Get extended data, only the fields requested
         """
         params = {
             'nroRuc': ruc,
             'desRuc': nombre,
         }
         data = {}
-        data['deuda_coactiva'] = self.get_deuda_coactiva_contribuyente(params)
-        data['omision_tributaria'] = self.get_omision_tributaria_contribuyente(params)
+        if 'deuda_coactiva' in fields:
+            data['deuda_coactiva'] = self.get_deuda_coactiva_contribuyente(params)
+        if 'omision_tributaria' in fields:
+            data['omision_tributaria'] = self.get_omision_tributaria_contribuyente(params)
         return data
 
-    def parse_results_file(self, fileobj):
-        text = fileobj.read()
+    async def aget_extended_information(self, ruc, nombre, session, fields=EXTENDED_FIELDS):
+        """
+        Get extended data, the fields requested are fetched concurrently
+        """
+        params = {
+            'nroRuc': ruc,
+            'desRuc': nombre,
+        }
+        actions = [
+            ('deuda_coactiva', 'getInfoDC', self.get_deuda_from_row),
+            ('omision_tributaria', 'getInfoOT', self.get_ot_from_row),
+        ]
+        actions = [action for action in actions if action[0] in fields]
+        results = await asyncio.gather(*[
+            self.aget_extended_info_attr(session, params, accion, func_from_row)
+            for field, accion, func_from_row in actions
+        ])
+        return {field: result for (field, _, _), result in zip(actions, results)}
+
+    async def aget_extended_information_batch(self, items, max_concurrency=10,
+                                              fields=EXTENDED_FIELDS):
+        """
+        Get extended data for many (ruc, nombre) pairs over a single
+        keep-alive connection pool. At most max_concurrency RUCs are in
+        flight at once. Results keep the order of items, failed queries
+        are returned as None
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        # Each RUC opens two requests at the same time
+        connector = aiohttp.TCPConnector(limit=max_concurrency * 2)
+
+        async def query(session, ruc, nombre):
+            async with semaphore:
+                try:
+                    data = await self.aget_extended_information(ruc, nombre, session, fields)
+                except Exception as e:
+                    self.logger.error(e)
+                    self.report_rate(e)
+                    return None
+                self.report_rate()
+                return data
+
+        async with aiohttp.ClientSession(connector=connector) as session:
+            return await asyncio.gather(*[
+                query(session, ruc, nombre) for ruc, nombre in items
+            ])
+
+    def get_extended_information_batch(self, items, max_concurrency=10,
+                                       fields=EXTENDED_FIELDS):
+        return asyncio.run(
+            self.aget_extended_information_batch(items, max_concurrency, fields)
+        )
+
+    def parse_results_file(self, fileobj, fields=ALL_FIELDS):
+        return self.parse_results(fileobj.read(), fields)
+
+    def parse_results(self, text, fields=ALL_FIELDS):
+        """
+        The CIIU list is only extracted if 'ciiu' is in fields
+        """
+        if self.parser == 'lxml':
+            return self.parse_results_lxml(text, fields)
+        return self.parse_results_bs4(text, fields)
+
+    def parse_results_bs4(self, text, fields=ALL_FIELDS):
         html = bs4.BeautifulSoup(text, "lxml")
 
         error = html.find('p', {'class': 'error'})
         if error is not None:
-            raise AttributeError(error.get_text())
+            raise error_page(error.get_text())
 
+        index = self.get_label_index_bs4(html)
+        data = self.get_indexed_fields(index)
+        if 'ciiu' in fields:
+            data['ciiu'] = self.get_ciiu_contribuyente(html)
+
+        return Contribuyente.from_dict(data)
+
+    def get_indexed_fields(self, index):
         data = {}
 
-        data['ruc'], data['nombre'] = self.get_ruc_nombre_contribuyente(html)
-        data['nombre_comercial'] = self.get_nombre_comercial_contribuyente(html)
-        data['estado'] = self.get_estado_contribuyente(html)
-        data['condicion'] = self.get_condicion_contribuyente(html)
-        data['ciiu'] = self.get_ciiu_contribuyente(html)
+        data['ruc'], data['nombre'] = self.get_ruc_nombre_contribuyente(index)
+        data['nombre_comercial'] = self.get_nombre_comercial_contribuyente(index)
+        data['estado'] = self.get_estado_contribuyente(index)
+        data['condicion'] = self.get_condicion_contribuyente(index)
 
         return data
 
+    def parse_results_lxml(self, text, fields=ALL_FIELDS):
+        """
+        Same as parse_results_bs4, using lxml directly without building a
+        BeautifulSoup tree
+        """
+        tree = lxml.html.fromstring(text)
+
+        error = tree.xpath('//p[@class="error"]')
+        if error:
+            raise error_page(error[0].text_content())
+
+        index = self.get_label_index_lxml(tree)
+        data = self.get_indexed_fields(index)
+        if 'ciiu' not in fields:
+            return Contribuyente.from_dict(data)
+
+        comments = self.get_ciiu_from_comments(
+            comment.text for comment in tree.xpath('//comment()')
+        )
+        options = tree.xpath('//select[@name="select"]/option')
+        options = [CIIU.from_string(op.text_content()) for op in options]
+        data['ciiu'] = self.get_clean_ciiu_list(comments, options)
+        return Contribuyente.from_dict(data)
+
     def get_search_frame(self, driver):
         search_frame_xpath = '//frame[@src="frameCriterioBusqueda.jsp"]'
         try:
@@ -328,9 +650,12 @@ class Sunat:
     def solve_captcha(self, driver):
         search_frame = self.get_search_frame(driver)
         captcha = self.get_captcha_text(search_frame)
+        return self.check_captcha(captcha)
+
+    def check_captcha(self, captcha):
         self.logger.info("Text in captcha: %s", captcha)
         if not captcha or len(captcha) != 4:
-            raise ValueError("Error reading captcha: {}".format(captcha))
+            raise CaptchaError("Error reading captcha: {}".format(captcha))
         return captcha
 
     def submit_search_form(self, type, value, captcha):
@@ -365,36 +690,143 @@ class Sunat:
             raise
 
         type_radio.click()
+        # The form keeps the values of the previous search when reused
+        value_input.clear()
         value_input.send_keys(str(value))
+        captcha_input.clear()
         captcha_input.send_keys(str(captcha))
+        self.throttle()
         submit_btn.click()
         self.web_driver.switch_to_default_content()
 
-    def get_basic_information(self, ruc):
-        self.web_driver.get(self.url_consulta)
+    def search(self, ruc, captcha):
+        """
+        Submits the search form already loaded and returns the result page
+        """
+        with self.metrics.timer('submit'):
+            self.submit_search_form('ruc', ruc, captcha)
+        return self.get_results_source()
+
+    def load_search_page(self):
+        self.throttle()
+        with self.metrics.timer('page_load'):
+            self.web_driver.get(self.url_consulta)
+
+    def get_basic_information(self, ruc, fields=ALL_FIELDS):
+        if self.reuse_captcha and self.captcha is not None:
+            data = self.search_with_solved_captcha(ruc, fields)
+            if data is not None:
+                return data
+
+        self.load_search_page()
         captcha = self.solve_captcha(self.web_driver)
-        self.submit_search_form('ruc', ruc, captcha)
+        source = self.search(ruc, captcha)
+        data = self.parse_submitted_results(source, fields=fields)
+        self.captcha = captcha
+        return data
 
-        tmp_file = tempfile.TemporaryFile(mode='w+', encoding="utf-8")
-        self.save_results(tmp_file)
-        data = self.parse_results_file(tmp_file)
-        tmp_file.close()
+    def search_with_solved_captcha(self, ruc, fields=ALL_FIELDS):
+        """
+        Searches with the last accepted captcha, without loading the page
+        and reading a new captcha. Returns None, forgetting the captcha, when
+        SUNAT doesn't accept it anymore
+        """
+        source = self.search(ruc, self.captcha)
+        try:
+            data = self.parse_submitted_results(source, report=False, fields=fields)
+        except SunatOverloadedPage:
+            raise
+        except SunatErrorPage:
+            self.logger.info("Captcha %s expired, solving a new one", self.captcha)
+            self.captcha = None
+            return None
+        if data.ruc != int(ruc):
+            # The result frame still had the previous search
+            self.captcha = None
+            return None
+        self.captcha_solver.report_reuse()
         return data
 
-    def get_all_information_util(self, ruc):
-        basic_data = self.get_basic_information(ruc)
-        ext_data = self.get_extended_information(ruc, basic_data['nombre'])
-        data = {}
-        data.update(basic_data)
-        data.update(ext_data)
+    def parse_submitted_results(self, text, report=True, fields=ALL_FIELDS):
+        """
+        Parses the results of a search and tells the captcha solver whether
+        its answer was accepted (SUNAT answers with an error page otherwise)
+        """
+        try:
+            with self.metrics.timer('parse'):
+                data = self.parse_results(text, fields)
+        except SunatOverloadedPage:
+            # The captcha wasn't checked, nothing to report
+            raise
+        except SunatErrorPage:
+            if report:
+                self.captcha_solver.report(False)
+            raise
+        except (AttributeError, IndexError, KeyError, ValueError) as e:
+            # The captcha was accepted but the page couldn't be parsed
+            if report:
+                self.captcha_solver.report(True)
+            raise ResultParseError(getattr(e, 'message', str(e))) from e
+        if report:
+            self.captcha_solver.report(True)
         return data
 
-    def get_all_information(self, ruc):
+    def get_all_information_util(self, ruc, extended=True, fields=ALL_FIELDS):
+        """
+        Returns a Contribuyente with the requested fields, ruc is always
+        included. With extended=False the extended fields are only taken
+        from the cache
+        """
+        basic_fields = set(BASIC_FIELDS).intersection(fields)
+        ext_fields = set(EXTENDED_FIELDS).intersection(fields)
+        needed = basic_fields | {'ruc'}
+        if ext_fields:
+            # nombre is a parameter of the extended requests
+            needed.add('nombre')
+
+        basic_data = None
+        ext_data = {}
+        if self.cache is not None:
+            basic_data, cached_ext = self.cache.get(ruc)
+            ext_data = cached_ext or {}
+            if isinstance(basic_data, dict):
+                # Cached before the parser returned records
+                basic_data = Contribuyente.from_dict(basic_data)
+            if basic_data is not None and not needed.issubset(basic_data.fields):
+                # Cached by a query that didn't need some of the fields
+                basic_data = None
+            if basic_data is not None:
+                self.logger.info("Basic information for RUC %d found in cache", ruc)
+
+        if basic_data is None and self.padron is not None and needed.issubset(PADRON_FIELDS):
+            padron_data = self.padron.get(ruc)
+            if padron_data is not None:
+                basic_data = Contribuyente.from_dict(padron_data)
+                self.logger.info("Basic information for RUC %d found in padrón", ruc)
+
+        if basic_data is None:
+            basic_data = self.get_basic_information(ruc, fields)
+            if self.cache is not None:
+                self.cache.put_basic(ruc, basic_data)
+
+        missing = ext_fields.difference(ext_data)
+        if extended and missing:
+            ext_data = dict(ext_data, **self.get_extended_information(ruc, basic_data.nombre, missing))
+            if self.cache is not None:
+                self.cache.put_extended(ruc, ext_data)
+
+        basic_data.update({key: value for key, value in ext_data.items() if key in fields})
+        basic_data.keep(fields)
+        return basic_data
+
+    def get_all_information(self, ruc, extended=True, fields=ALL_FIELDS):
         if not self.validate_ruc(ruc):
             raise InvalidRUCError("Invalid RUC: {ruc}".format(ruc=ruc))
+        check_fields(fields)
 
-        args = [ruc]
-        return self.query_wrapper(self.get_all_information_util, *args)
+        args = [ruc, extended, fields]
+        with self.metrics.timer('query'):
+            return self.query_wrapper(self.get_all_information_util, *args)
 
     def get_ruc_list_in_frame(self, frame):
         return []
@@ -403,17 +835,28 @@ class Sunat:
         try:
             data = None
             data = func(*args)
-        except TimeoutException:
+            self.timeouts = 0
+            self.report_rate()
+        except TimeoutException as e:
+            self.timeouts += 1
+            self.report_rate(e)
             self.logger.error("Page load timed out")
+            if self.raise_errors:
+                raise
             self.logger.info('Waiting before retry...')
             self.web_driver.implicitly_wait(5)
         except Exception as e:
+            self.report_rate(e)
             self.logger.error(e)
+            if self.raise_errors:
+                raise
         finally:
-            self.web_driver.switch_to_default_content()
+            if self.web_driver is not None:
+                self.web_driver.switch_to_default_content()
         return data
 
     def get_ruc_list_by_name_util(self, name):
+        self.throttle()
         self.web_driver.get(self.url_consulta)
         captcha = self.solve_captcha(self.web_driver)
         self.submit_search_form('name', name, captcha)
@@ -424,7 +867,8 @@ class Sunat:
         args = [name]
         return self.query_wrapper(self.get_ruc_list_by_name_util, *args)
 
-    def validate_ruc(self, ruc):
+    @staticmethod
+    def validate_ruc(ruc):
         ruc_str = str(ruc)
 
         if len(ruc_str) != 11:
@@ -0,0 +1,78 @@
+from PIL import Image
+import io
+from .sunat import Sunat
+
+
+class SunatHTTP(Sunat):
+    """
+    Queries SUNAT through plain HTTP requests, without a web browser.
+    Session cookies are kept by the requests session, so the captcha
+    fetched here is the one the server expects in the search form
+    """
+    def __init__(self, session, logger, timeout=5, **kwargs):
+        super().__init__(None, logger, session, **kwargs)
+        self.timeout = timeout
+        base_url = self.url_consulta.rsplit('/', 1)[0]
+        self.url_captcha = base_url + '/captcha'
+        self.url_resultado = base_url + '/frameResultadoBusqueda.html'
+
+    def get_captcha_image(self):
+        self.throttle()
+        with self.metrics.timer('captcha_image'):
+            res = self.session.get(
+                self.url_captcha,
+                params={'accion': 'image'},
+                timeout=self.timeout
+            )
+            res.raise_for_status()
+        return Image.open(io.BytesIO(res.content))
+
+    def get_captcha_text(self):
+        captcha = self.get_captcha_image()
+        return self.get_text_from_image(captcha)
+
+    def solve_captcha(self, driver=None):
+        # There's no web driver, the captcha comes from the HTTP session
+        captcha = self.get_captcha_text()
+        return self.check_captcha(captcha)
+
+    def submit_search_form(self, type, value, captcha):
+        if type != 'ruc':
+            raise ValueError("Only RUC queries are supported over HTTP")
+
+        form = {
+            'accion': 'consPorRuc',
+            'nroRuc': str(value),
+            'search1': str(value),
+            'codigo': str(captcha),
+            'tipdoc': '1',
+        }
+        self.throttle()
+        with self.metrics.timer('submit'):
+            res = self.session.post(
+                self.url_consulta,
+                data=form,
+                timeout=self.timeout
+            )
+            res.raise_for_status()
+        return res
+
+    def fetch_results_source(self, res):
+        # The form response may be the frameset itself instead of the
+        # result page, in that case the result frame is requested by URL
+        if 'frameResultadoBusqueda.html' in res.text:
+            self.throttle()
+            with self.metrics.timer('result_frame'):
+                res = self.session.get(self.url_resultado, timeout=self.timeout)
+                res.raise_for_status()
+        return res.text
+
+    def search(self, ruc, captcha):
+        res = self.submit_search_form('ruc', ruc, captcha)
+        return self.fetch_results_source(res)
+
+    def load_search_page(self):
+        # Loading the main page sets the session cookies
+        self.throttle()
+        with self.metrics.timer('page_load'):
+            self.session.get(self.url_consulta, timeout=self.timeout)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Captcha telemetry. Every captcha read can be recorded with its OCR text,
+the preprocessing settings, the solve latency and whether SUNAT accepted
+the answer. The stored images can then be replayed against alternative
+preprocessing settings to choose the ones with the best accuracy:
+
+    python telemetry.py captcha-log.sqlite3 --save captcha-settings.json
+"""
+import sys
+import argparse
+import itertools
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append("..")
+from ConsultaSunat.captcha import (
+    CaptchaSolver,
+    TemplateClassifier,
+    DEFAULT_SETTINGS,
+    CAPTCHA_LENGTH
+)
+
+
+# Alternative settings tried by replay, every combination is evaluated
+SETTINGS_GRID = {
+    'threshold': [100, 120, 140, 160, 180],
+    'denoise': [0, 3, 5],
+    'scale': [1, 2, 3],
+}
+
+
+class CaptchaLog:
+    """
+    SQLite store of captcha attempts. accepted is NULL while the answer
+    hasn't been submitted, and stays NULL if it never was (wrong length)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS attempts ('
+                'id INTEGER PRIMARY KEY, '
+                'created REAL, text TEXT, settings TEXT, latency REAL, '
+                'accepted INTEGER, image BLOB)'
+            )
+
+    def record(self, png, text, settings, latency):
+        """
+        Stores an attempt and returns its id
+        """
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                'INSERT INTO attempts (created, text, settings, latency, image) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (time.time(), text, json.dumps(settings, sort_keys=True), latency,
+                 sqlite3.Binary(png))
+            )
+        return cursor.lastrowid
+
+    def set_accepted(self, attempt_id, accepted):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'UPDATE attempts SET accepted = ? WHERE id = ?',
+                (int(accepted), attempt_id)
+            )
+
+    def summary(self):
+        """
+        Returns (settings, attempts, valid length, submitted, accepted,
+        average latency) for each group of settings used
+        """
+        with self.lock:
+            return self.conn.execute(
+                'SELECT settings, COUNT(*), SUM(LENGTH(text) = ?), '
+                'COUNT(accepted), SUM(accepted = 1), AVG(latency) '
+                'FROM attempts GROUP BY settings ORDER BY COUNT(*) DESC',
+                (CAPTCHA_LENGTH,)
+            ).fetchall()
+
+    def submitted(self):
+        """
+        Yields (PNG image, text, accepted) for the answers sent to SUNAT
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT image, text, accepted FROM attempts '
+                'WHERE accepted IS NOT NULL ORDER BY id'
+            ).fetchall()
+        for image, text, accepted in rows:
+            yield bytes(image), text, bool(accepted)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def settings_candidates(grid=None):
+    grid = grid or SETTINGS_GRID
+    keys = sorted(grid)
+    for values in itertools.product(*(grid[key] for key in keys)):
+        yield dict(DEFAULT_SETTINGS, **dict(zip(keys, values)))
+
+
+def replay(attempts, settings, logger, classifier=None, workers=1):
+    """
+    Reads the stored captchas again with settings. Accepted answers are
+    known to be right, so they measure the accuracy. For rejected ones only
+    the wrong answer is known, repeating it counts as an error.
+    Returns (right, wrong, known wrong answers repeated)
+    """
+    solver = CaptchaSolver(logger, classifier, settings)
+    images = [png for png, text, accepted in attempts]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        texts = list(executor.map(solver.solve, images))
+
+    right = wrong = repeated = 0
+    for (png, answer, accepted), text in zip(attempts, texts):
+        if accepted:
+            if text == answer:
+                right += 1
+            else:
+                wrong += 1
+        elif text == answer:
+            repeated += 1
+    return right, wrong, repeated
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        description="Show captcha statistics and replay stored captchas with other settings"
+    )
+    arg_parser.add_argument('log', help='Captcha log created with consulta.py --captcha-log')
+    arg_parser.add_argument(
+        '--captcha-templates',
+        help='Glyph templates file, to replay the same pipeline used by consulta.py'
+    )
+    arg_parser.add_argument('--workers', type=int, default=1, help='Threads used to read captchas')
+    arg_parser.add_argument(
+        '--save',
+        metavar='FILE',
+        help='Save the best settings as JSON, to be used with consulta.py --captcha-settings'
+    )
+    args = arg_parser.parse_args(argv)
+
+    logger = logging.getLogger('sunat')
+    log = CaptchaLog(args.log)
+    for settings, attempts, valid, submitted, accepted, latency in log.summary():
+        print("{settings}: {attempts} read ({latency:.3f} s average), {valid} with valid length, "
+              "{accepted}/{submitted} accepted ({rate:.1%})".format(
+                  settings=settings,
+                  attempts=attempts,
+                  latency=latency or 0,
+                  valid=valid or 0,
+                  accepted=accepted or 0,
+                  submitted=submitted,
+                  rate=(accepted or 0) / submitted if submitted else 0
+              ))
+
+    attempts = list(log.submitted())
+    log.close()
+    labelled = sum(1 for png, text, accepted in attempts if accepted)
+    if not labelled:
+        print("No accepted captchas to replay")
+        return
+
+    classifier = None
+    if args.captcha_templates:
+        classifier = TemplateClassifier.load(args.captcha_templates)
+
+    results = []
+    for settings in settings_candidates():
+        right, wrong, repeated = replay(attempts, settings, logger, classifier, args.workers)
+        results.append((right, -repeated, settings))
+        print("{}: {}/{} right ({:.1%}), {} known wrong answers repeated".format(
+            json.dumps(settings, sort_keys=True), right, labelled, right / labelled, repeated))
+
+    # On a tie the current defaults are kept
+    right, repeated, best = max(
+        results,
+        key=lambda result: result[:2] + (result[2] == DEFAULT_SETTINGS,)
+    )
+    print("Best settings: {} ({:.1%} right)".format(json.dumps(best, sort_keys=True), right / labelled))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(best, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import os
+import sys
+import logging
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from ConsultaSunat import fake_sunat
+from ConsultaSunat.sunat import Sunat
+from ConsultaSunat.utils import CIIU
+
+
+DATA = {
+    'ruc': 20331066703,
+    'nombre': 'EMPRESA DE PRUEBA S.A.C.',
+    'nombre_comercial': '-',
+    'estado': 'ACTIVO',
+    'condicion': 'HABIDO',
+    'ciiu': [
+        (51906, 'OTROS TIPOS DE VENTA AL POR MAYOR.'),
+        (74142, 'ACTIVIDADES DE ASESORAMIENTO EMPRESARIAL.'),
+    ],
+    'ciiu_rev3': [(52399, 'VENTA AL POR MENOR EN ALMACENES NO ESPECIALIZADOS.')],
+}
+
+# Commented out select split over several comments, as SUNAT writes it
+SPLIT_COMMENTS_PAGE = """<html><body>
+<table>
+<tr><td class="bgn">N&uacute;mero de RUC: </td><td class="bg">20331066703 - EMPRESA DE PRUEBA S.A.C.</td></tr>
+<tr><td class="bgn">Nombre Comercial:</td><td class="bg">-</td></tr>
+<tr><td class="bgn">Estado del Contribuyente:</td><td class="bg">ACTIVO</td></tr>
+<tr><td class="bgn">Condici&oacute;n del Contribuyente:</td><td class="bg">HABIDO</td></tr>
+<tr><td class="bgn">Actividad(es) Econ&oacute;mica(s):</td><td class="bg">
+<select name="select">
+<option value="00">Principal    - 46900 - VENTA AL POR MAYOR NO ESPECIALIZADA</option>
+<option value="00">Secundaria 1 - 70200 - ACTIVIDADES DE CONSULTOR&Iacute;A DE GESTI&Oacute;N</option>
+</select>
+<!--<select name="select">-->
+<!--<option value="00">Principal    - CIIU 51906 - OTROS TIPOS DE VENTA AL POR MAYOR.-->
+<!--<option value="00">Secundaria 1 - CIIU 74142 - ACTIVIDADES DE ASESORAMIENTO EMPRESARIAL.</option>-->
+<!--</select>-->
+<!-- Otro comentario <option>no es un CIIU</option> -->
+</td></tr>
+</table></body></html>"""
+
+
+def codes(ciiu_list):
+    return [(ci.codigo, ci.revision) for ci in ciiu_list]
+
+
+class CIIUTest(unittest.TestCase):
+    parser = 'bs4'
+
+    def setUp(self):
+        self.sunat = Sunat(None, logging.getLogger('test'), parser=self.parser)
+
+    def test_both_revisions(self):
+        data = self.sunat.parse_results(fake_sunat.result_page(DATA))
+        self.assertEqual(codes(data.ciiu), [(51906, 4), (74142, 4), (52399, 3)])
+        self.assertEqual(data.ciiu[2].descripcion, 'VENTA AL POR MENOR EN ALMACENES NO ESPECIALIZADOS.')
+
+    def test_revision_3_duplicates_removed(self):
+        # The same code in the select and in the commented out select
+        data = dict(DATA, ciiu_rev3=DATA['ciiu'][:1])
+        data = self.sunat.parse_results(fake_sunat.result_page(data))
+        self.assertEqual(codes(data.ciiu), [(74142, 4), (51906, 3)])
+
+    def test_only_revision_4(self):
+        data = dict(DATA, ciiu_rev3=[])
+        data = self.sunat.parse_results(fake_sunat.result_page(data))
+        self.assertEqual(codes(data.ciiu), [(51906, 4), (74142, 4)])
+
+    def test_split_comments(self):
+        data = self.sunat.parse_results(SPLIT_COMMENTS_PAGE)
+        self.assertEqual(
+            codes(data.ciiu),
+            [(46900, 4), (70200, 4), (51906, 3), (74142, 3)]
+        )
+        self.assertEqual(data.ciiu[1].descripcion, 'ACTIVIDADES DE CONSULTORÍA DE GESTIÓN')
+
+    def test_ciiu_not_requested(self):
+        data = self.sunat.parse_results(SPLIT_COMMENTS_PAGE, fields=('ruc', 'estado'))
+        self.assertNotIn('ciiu', data)
+
+
+class CIIULxmlTest(CIIUTest):
+    parser = 'lxml'
+
+
+class CleanCIIUListTest(unittest.TestCase):
+    def setUp(self):
+        self.sunat = Sunat(None, logging.getLogger('test'))
+
+    def test_comments_ignored_before_select(self):
+        comments = [
+            '<option>Principal - CIIU 11111 - ANTES DEL SELECT</option>',
+            '<select name="select"><option>Principal - CIIU 51906 - VENTA</option></select>',
+            '<option>Principal - CIIU 22222 - DESPUES DEL SELECT</option>',
+        ]
+        self.assertEqual(codes(self.sunat.get_ciiu_from_comments(comments)), [(51906, 3)])
+
+    def test_clean_list(self):
+        comments = [CIIU(51906, 'VENTA'), CIIU(74142, 'ASESORAMIENTO')]
+        options = [CIIU(46900, 'VENTA'), CIIU(51906, 'VENTA')]
+        clean = self.sunat.get_clean_ciiu_list(comments, options)
+        self.assertEqual(codes(clean), [(46900, 4), (51906, 3), (74142, 3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
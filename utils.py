@@ -1,9 +1,17 @@
 import json
 import datetime
+from array import array
 from abc import ABCMeta, abstractmethod
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class JSONEnabled(metaclass=ABCMeta):
+    __slots__ = ()
+
     @abstractmethod
     def _json(self):
         """To override"""
@@ -14,28 +22,86 @@ class JSONEnabled(metaclass=ABCMeta):
         return json.JSONEncoder
 
 
-class DateJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if not (isinstance(obj, datetime.date) or
-                isinstance(obj, datetime.datetime)):
-            return json.dumps(obj, indent=2, ensure_ascii=False)
+def encode_date(value):
+    """
+    Las fechas se guardan como {"year", "month"}, otros valores sin cambios
+    """
+    if isinstance(value, datetime.date):
         return {
-            "year": obj.year,
-            "month": obj.month
+            "year": value.year,
+            "month": value.month
         }
+    return value
+
+
+def json_default(obj):
+    """
+    Convierte los tipos de este modulo a tipos JSON. Se usa como `default`
+    del encoder, que solo la llama para los objetos que no sabe serializar
+    """
+    if isinstance(obj, JSONEnabled):
+        return obj._json()
+    if isinstance(obj, datetime.date):
+        return encode_date(obj)
+    raise TypeError(
+        "Object of type {} is not JSON serializable".format(type(obj).__name__)
+    )
+
+
+class DateJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        return json_default(obj)
 
 
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, obj):
-        if not isinstance(obj, JSONEnabled):
-            return json.dumps(obj, indent=2, ensure_ascii=False)
-        return obj._json()
+        return json_default(obj)
+
+
+JSON_BACKEND = 'orjson' if orjson is not None else 'json'
+# Un solo encoder compacto para todas las llamadas a dumps
+_compact_encoder = json.JSONEncoder(
+    ensure_ascii=False,
+    separators=(',', ':'),
+    default=json_default
+)
+
+
+def dumps(obj, indent=None, backend=None):
+    """
+    Serializa obj (diccionarios, listas y tipos de este modulo) a un str.
+    Sin indent la salida es compacta. Usa orjson si esta instalado
+    """
+    backend = backend or JSON_BACKEND
+    if backend == 'orjson' and indent in (None, 2):
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=json_default, option=option).decode('utf-8')
+    if indent is None:
+        return _compact_encoder.encode(obj)
+    return json.dumps(obj, ensure_ascii=False, indent=indent, default=json_default)
+
+
+def write_jsonl(records, fileobj, backend=None):
+    """
+    Escribe cada registro en una linea (JSON Lines) a medida que se
+    consume records. Devuelve el numero de registros escritos
+    """
+    count = 0
+    for record in records:
+        fileobj.write(dumps(record, backend=backend))
+        fileobj.write('\n')
+        count += 1
+    return count
 
 
 class CIIU(JSONEnabled):
     """
     Tipo CIIU que define una actividad economica de un contribyente
     """
+    __slots__ = ('codigo', 'descripcion', 'revision')
+
     def __init__(self, codigo=0, descripcion="", revision=3):
         self.codigo = codigo
         self.descripcion = descripcion
@@ -78,6 +144,8 @@ class DeudaCoactiva(JSONEnabled):
     """
     Representa la deuda coactiva de un contribuyente
     """
+    __slots__ = ('monto', 'periodo_tributario', 'fecha_inicio', 'entidad_asociada')
+
     def __init__(self,
                  monto=0,
                  periodo_tributario=None,
@@ -92,13 +160,10 @@ class DeudaCoactiva(JSONEnabled):
         return CustomJSONEncoder
 
     def _json(self):
-        datetime_encode = DateJSONEncoder()
         return {
             "monto": self.monto,
-            "periodo_tributario": datetime_encode.default(
-                self.periodo_tributario
-            ),
-            "fecha_inicio": datetime_encode.default(self.fecha_inicio),
+            "periodo_tributario": encode_date(self.periodo_tributario),
+            "fecha_inicio": encode_date(self.fecha_inicio),
             "entidad_asociada": self.entidad_asociada
         }
 
@@ -110,6 +175,8 @@ class OmisionTributaria(JSONEnabled):
     """
     Representa la omision tributaria de un contribuyente
     """
+    __slots__ = ('periodo_tributario', 'tributo')
+
     def __init__(self, periodo_tributario=None, tributo=""):
         self.periodo_tributario = periodo_tributario
         self.tributo = tributo
@@ -118,11 +185,8 @@ class OmisionTributaria(JSONEnabled):
         return CustomJSONEncoder
 
     def _json(self):
-        datetime_encode = DateJSONEncoder()
         return {
-            "periodo_tributario": datetime_encode.default(
-                self.periodo_tributario
-            ),
+            "periodo_tributario": encode_date(self.periodo_tributario),
             "tributo": self.tributo
         }
 
@@ -131,45 +195,184 @@ class OmisionTributaria(JSONEnabled):
 
 
 class Contribuyente(JSONEnabled):
+    """
+    Contribuyente devuelto por Sunat. fields son los campos obtenidos, los
+    demas quedan con su valor por defecto y no se escriben en el JSON
+    """
+    FIELDS = (
+        'ruc',
+        'nombre',
+        'nombre_comercial',
+        'condicion',
+        'estado',
+        'deuda_coactiva',
+        'omision_tributaria',
+        'ciiu'
+    )
+    __slots__ = FIELDS + ('fields',)
+    # Una sola tupla por combinacion de campos, compartida por los registros
+    _field_tuples = {}
+
     def __init__(self,
                  ruc=None,
                  nombre='-',
                  nombre_comercial='-',
                  condicion='',
                  estado='',
-                 deuda_coactiva=[],
-                 omision_tributaria=[],
-                 ciiu=[]):
+                 deuda_coactiva=None,
+                 omision_tributaria=None,
+                 ciiu=None,
+                 fields=None):
         self.ruc = ruc
         self.nombre = nombre
         self.nombre_comercial = nombre_comercial
         self.condicion = condicion
         self.estado = estado
-        self.deuda_coactiva = deuda_coactiva
-        self.omision_tributaria = omision_tributaria
-        self.ciiu = ciiu
+        self.deuda_coactiva = deuda_coactiva if deuda_coactiva is not None else []
+        self.omision_tributaria = omision_tributaria if omision_tributaria is not None else []
+        self.ciiu = ciiu if ciiu is not None else []
+        self.fields = self.FIELDS if fields is None else self._tuple(
+            field for field in self.FIELDS if field in fields
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Crea un contribuyente con los campos presentes en data
+        """
+        values = {key: data[key] for key in cls.FIELDS if key in data}
+        return cls(fields=values.keys(), **values)
+
+    @classmethod
+    def _tuple(cls, fields):
+        fields = tuple(fields)
+        return cls._field_tuples.setdefault(fields, fields)
+
+    def __contains__(self, field):
+        return field in self.fields
+
+    def update(self, data):
+        """
+        Agrega o reemplaza los campos de data, por ejemplo la informacion
+        extendida
+        """
+        for key, value in data.items():
+            setattr(self, key, value)
+        self.fields = self._tuple(
+            field for field in self.FIELDS if field in self.fields or field in data
+        )
+
+    def keep(self, fields):
+        """
+        Descarta los campos que no estan en fields, salvo el RUC
+        """
+        self.fields = self._tuple(
+            field for field in self.fields if field == 'ruc' or field in fields
+        )
+
+    def to_dict(self):
+        """
+        Los campos obtenidos en tipos JSON
+        """
+        return self._json()
 
     def json_class(self):
         return CustomJSONEncoder
 
     def _json(self):
-        encoder = self.json_class()()
-        return {
+        data = {
             "ruc": int(self.ruc),
             "nombre": self.nombre,
             "nombre_comercial": self.nombre_comercial,
             "condicion": self.condicion,
             "estado": self.estado,
-            "deuda_coactiva": [
-                encoder.default(dc) for dc in self.deuda_coactiva
-            ],
+            "deuda_coactiva": [dc._json() for dc in self.deuda_coactiva],
             "omision_tributaria": [
-                encoder.default(ot) for ot in self.omision_tributaria
+                ot._json() for ot in self.omision_tributaria
             ],
-            "ciiu": [encoder.default(ci) for ci in self.ciiu],
+            "ciiu": [ci._json() for ci in self.ciiu],
+        }
+        if len(self.fields) == len(self.FIELDS):
+            return data
+        return {
+            key: value for key, value in data.items()
+            if key == 'ruc' or key in self.fields
         }
 
     def __repr__(self):
         if self.ruc is None:
             return "Contribuyente inválido"
         return str(self._json())
+
+
+class ContribuyenteBatch:
+    """
+    Almacenamiento por columnas para muchos contribuyentes.
+    Los RUC se guardan en un arreglo de enteros y los valores de estado y
+    condicion (muy repetidos) como codigos de una tabla pequeña
+    """
+    def __init__(self, contribuyentes=()):
+        self.ruc = array('q')
+        self.nombre = []
+        self.nombre_comercial = []
+        self.estado = array('H')
+        self.condicion = array('H')
+        # Las listas vacias se guardan como None
+        self.deuda_coactiva = []
+        self.omision_tributaria = []
+        self.ciiu = []
+        # Tupla de campos obtenidos de cada fila, compartida entre filas
+        self.fields = []
+        self._values = []
+        self._codes = {}
+        for contribuyente in contribuyentes:
+            self.append(contribuyente)
+
+    def _code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = len(self._values)
+            self._codes[value] = code
+            self._values.append(value)
+        return code
+
+    def append(self, contribuyente):
+        """
+        Agrega un Contribuyente o un diccionario devuelto por Sunat
+        """
+        if isinstance(contribuyente, dict):
+            contribuyente = Contribuyente.from_dict(contribuyente)
+
+        self.ruc.append(int(contribuyente.ruc))
+        self.nombre.append(contribuyente.nombre)
+        self.nombre_comercial.append(contribuyente.nombre_comercial)
+        self.estado.append(self._code(contribuyente.estado))
+        self.condicion.append(self._code(contribuyente.condicion))
+        self.deuda_coactiva.append(contribuyente.deuda_coactiva or None)
+        self.omision_tributaria.append(contribuyente.omision_tributaria or None)
+        self.ciiu.append(contribuyente.ciiu or None)
+        self.fields.append(contribuyente.fields)
+
+    def __len__(self):
+        return len(self.ruc)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("ContribuyenteBatch index out of range")
+        return Contribuyente(
+            ruc=self.ruc[index],
+            nombre=self.nombre[index],
+            nombre_comercial=self.nombre_comercial[index],
+            condicion=self._values[self.condicion[index]],
+            estado=self._values[self.estado[index]],
+            deuda_coactiva=self.deuda_coactiva[index] or [],
+            omision_tributaria=self.omision_tributaria[index] or [],
+            ciiu=self.ciiu[index] or [],
+            fields=self.fields[index]
+        )
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Bulk RUC validation. Splits a file with one RUC per line into valid and
+invalid RUCs before querying SUNAT:
+
+    python validation.py rucs.txt validos.txt invalidos.txt
+"""
+import numpy
+import argparse
+import itertools
+
+
+VALID_PREFIXES = numpy.array([10, 15, 17, 20], dtype=numpy.int64)
+# Factors for the first 10 digits of the RUC, same as Sunat.validate_ruc
+FIXED_MULTIPLIERS = numpy.array([5, 4, 3, 2, 7, 6, 5, 4, 3, 2], dtype=numpy.int64)
+# Powers of ten to extract the 11 digits, most significant first
+DIGIT_POWERS = 10 ** numpy.arange(10, -1, -1, dtype=numpy.int64)
+
+
+def validate_rucs(rucs):
+    """
+    Vectorized version of Sunat.validate_ruc.
+    Takes an array (or sequence) of integer RUCs and returns a boolean array
+    """
+    rucs = numpy.asarray(rucs, dtype=numpy.int64)
+
+    eleven_digits = (rucs >= 10 ** 10) & (rucs < 10 ** 11)
+    valid_prefix = numpy.isin(rucs // 10 ** 9, VALID_PREFIXES)
+
+    digits = (rucs[:, numpy.newaxis] // DIGIT_POWERS) % 10
+    weighted_sum = digits[:, :10].dot(FIXED_MULTIPLIERS)
+    magic_number = (11 - weighted_sum % 11) % 10
+
+    return eleven_digits & valid_prefix & (magic_number == digits[:, 10])
+
+
+def split_rucs(lines):
+    """
+    Splits a chunk of lines into (valid RUCs, invalid lines). Invalid lines
+    are returned as they were read, without the line break
+    """
+    numeric = []
+    numeric_lines = []
+    invalid = []
+    for line in lines:
+        value = line.strip()
+        if not value:
+            continue
+        if len(value) == 11 and value.isdigit():
+            numeric.append(value)
+            numeric_lines.append(line.rstrip('\r\n'))
+        else:
+            invalid.append(line.rstrip('\r\n'))
+    if not numeric:
+        return numpy.zeros(0, dtype=numpy.int64), invalid
+
+    rucs = numpy.array(numeric).astype(numpy.int64)
+    valid = validate_rucs(rucs)
+    invalid.extend(line for line, ok in zip(numeric_lines, valid.tolist()) if not ok)
+    return rucs[valid], invalid
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        description="Split a file of RUCs into valid and invalid RUCs"
+    )
+    arg_parser.add_argument('infile', help='File with one RUC per line')
+    arg_parser.add_argument('valid', help='Where to save the valid RUCs')
+    arg_parser.add_argument('invalid', help='Where to save the invalid lines')
+    arg_parser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=10 ** 6,
+        help='Lines validated at once. Default: 1000000'
+    )
+    args = arg_parser.parse_args(argv)
+
+    num_valid = num_invalid = 0
+    with open(args.infile) as infile, \
+            open(args.valid, 'w') as valid_file, \
+            open(args.invalid, 'w') as invalid_file:
+        while True:
+            lines = list(itertools.islice(infile, args.chunk_size))
+            if not lines:
+                break
+            valid, invalid = split_rucs(lines)
+            valid_file.writelines('{}\n'.format(ruc) for ruc in valid.tolist())
+            invalid_file.writelines(value + '\n' for value in invalid)
+            num_valid += len(valid)
+            num_invalid += len(invalid)
+
+    print("{} valid RUCs saved to {}, {} invalid saved to {}".format(
+        num_valid, args.valid, num_invalid, args.invalid))
+
+
+if __name__ == '__main__':
+    main()